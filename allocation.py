@@ -0,0 +1,211 @@
+"""A compact record for the allocated ipam entries
+
+Big IP plans have millions of entries, so an entry only stores integers
+(and references to its properties and metadata). The netaddr objects and
+the strings of the output are created when they are accessed.
+"""
+
+import json
+import struct
+try:
+    from socket import AF_INET6, inet_ntop, inet_pton
+except ImportError:
+    # not available on Windows with python 2
+    inet_ntop = inet_pton = None
+
+import netaddr
+
+_MASK_64 = (1 << 64) - 1
+
+
+def ip_to_str(value, version):
+    """Convert an IP address, as int, to a string (the same as netaddr)"""
+    if version == 4:
+        return '{0}.{1}.{2}.{3}'.format(value >> 24, value >> 16 & 0xff,
+                                        value >> 8 & 0xff, value & 0xff)
+    if inet_ntop is not None:
+        # netaddr uses inet_ntop too, through an IPAddress object
+        return inet_ntop(AF_INET6,
+                         struct.pack('>QQ', value >> 64, value & _MASK_64))
+    return str(netaddr.IPAddress(value, 6))
+
+
+def ip_from_str(s):
+    """Convert an IP address string to (IP version, int)"""
+    if ':' in s:
+        if inet_pton is not None:
+            hi, lo = struct.unpack('>QQ', inet_pton(AF_INET6, s))
+            return 6, hi << 64 | lo
+    else:
+        parts = s.split('.')
+        if len(parts) == 4:
+            a, b, c, d = [int(x) for x in parts]
+            if max(a, b, c, d) <= 0xff:
+                return 4, a << 24 | b << 16 | c << 8 | d
+    ip = netaddr.IPAddress(s)
+    return ip.version, int(ip)
+
+
+class Allocation(object):
+    """An allocated ipam entry
+
+    It can be read like the dict used by the previous versions, e.g.
+    a['cidr'] returns a netaddr.IPNetwork and a['vlan'] the VLAN.
+    """
+
+    __slots__ = ('version', 'network', 'prefixlen', 'range_first',
+                 'range_last', 'gateway_offset', 'vlan', 'properties',
+                 'metadata')
+
+    # the keys of the entry, when read as a dict
+    KEYS = ('vlan', 'ip_range', 'gateway', 'cidr', 'prefixlen', 'netmask',
+            'properties', 'metadata')
+
+    def __init__(self, version, network, prefixlen, range_first, range_last,
+                 gateway_offset=None, vlan=None, properties=None,
+                 metadata=None):
+        """
+        :param version: the IP version
+        :param network: the first IP of the subnet (as int)
+        :param prefixlen: the prefixlen of the subnet
+        :param range_first: the first IP of the IP range (as int)
+        :param range_last: the last IP of the IP range (as int)
+        :param gateway_offset: the index of the gateway IP in the subnet
+            or None if there is no gateway
+        :param vlan: the VLAN or None
+        :param properties: the properties of the entry
+        :param metadata: the metadata of the entry
+        """
+        self.version = version
+        self.network = network
+        self.prefixlen = prefixlen
+        self.range_first = range_first
+        self.range_last = range_last
+        self.gateway_offset = gateway_offset
+        self.vlan = vlan
+        self.properties = properties if properties is not None else {}
+        self.metadata = metadata if metadata is not None else {}
+
+    @classmethod
+    def from_dict(cls, d):
+        """Create an Allocation from an entry in the json output"""
+        ip, prefixlen = d['cidr'].split('/')
+        version, network = ip_from_str(ip)
+        prefixlen = int(prefixlen)
+        gateway = d['gateway']
+        return cls(version, network, prefixlen,
+                   ip_from_str(d['ip_range']['start'])[1],
+                   ip_from_str(d['ip_range']['end'])[1],
+                   ip_from_str(gateway)[1] - network if gateway else None,
+                   d['vlan'], d.get('properties', {}), d['metadata'])
+
+    @property
+    def cidr(self):
+        return netaddr.IPNetwork((self.network, self.prefixlen),
+                                 version=self.version)
+
+    @property
+    def ip_range(self):
+        return netaddr.IPRange(
+            netaddr.IPAddress(self.range_first, self.version),
+            netaddr.IPAddress(self.range_last, self.version))
+
+    @property
+    def gateway(self):
+        if self.gateway_offset is None:
+            return None
+        return netaddr.IPAddress(self.network + self.gateway_offset,
+                                 self.version)
+
+    @property
+    def netmask(self):
+        return netaddr.IPAddress(self.netmask_int(), self.version)
+
+    def last(self):
+        """The last IP of the subnet (as int)"""
+        width = 32 if self.version == 4 else 128
+        return self.network + (1 << (width - self.prefixlen)) - 1
+
+    def netmask_int(self):
+        width = 32 if self.version == 4 else 128
+        return (1 << width) - (1 << (width - self.prefixlen))
+
+    def same_subnet(self, other):
+        """Check if the other allocation is in the same subnet"""
+        return (self.version, self.network, self.prefixlen) == \
+            (other.version, other.network, other.prefixlen)
+
+    def __getitem__(self, k):
+        if k not in self.KEYS:
+            raise KeyError(k)
+        return getattr(self, k)
+
+    def __contains__(self, k):
+        return k in self.KEYS
+
+    def get(self, k, default=None):
+        return self[k] if k in self.KEYS else default
+
+    def keys(self):
+        return list(self.KEYS)
+
+    def items(self):
+        return [(k, self[k]) for k in self.KEYS]
+
+    def __eq__(self, other):
+        """Two allocations are equal if they have the same json output"""
+        if not isinstance(other, Allocation):
+            return NotImplemented
+        for k in self.__slots__:
+            x, y = getattr(self, k), getattr(other, k)
+            # e.g. the tuples in the metadata are lists once loaded from
+            # the json output
+            if x != y and json.dumps(x, sort_keys=True) != \
+                    json.dumps(y, sort_keys=True):
+                return False
+        return True
+
+    def __ne__(self, other):
+        res = self.__eq__(other)
+        return res if res is NotImplemented else not res
+
+    # mutable, like the dicts used by the previous versions
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Allocation({0})'.format(
+            ', '.join('{0}={1!r}'.format(k, v) for k, v in self.items()))
+
+    def cidr_str(self):
+        return '{0}/{1}'.format(ip_to_str(self.network, self.version),
+                                self.prefixlen)
+
+    def ip_range_str(self):
+        return '{0}-{1}'.format(ip_to_str(self.range_first, self.version),
+                                ip_to_str(self.range_last, self.version))
+
+    def gateway_str(self):
+        """The gateway IP as string, or None if there is no gateway"""
+        if self.gateway_offset is None:
+            return None
+        return ip_to_str(self.network + self.gateway_offset, self.version)
+
+    def to_dict(self):
+        """Convert the entry to the dict of the json output"""
+        start = ip_to_str(self.range_first, self.version)
+        end = ip_to_str(self.range_last, self.version)
+        return {
+            'vlan': self.vlan,
+            'ip_range': {
+                'start': start,
+                'end': end,
+                'str': '{0}-{1}'.format(start, end),
+                'size': self.range_last - self.range_first + 1,
+            },
+            'gateway': self.gateway_str(),
+            'cidr': self.cidr_str(),
+            'prefixlen': self.prefixlen,
+            'netmask': ip_to_str(self.netmask_int(), self.version),
+            'properties': self.properties,
+            'metadata': self.metadata,
+        }
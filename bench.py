@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+
+"""Benchmarks for ipa
+
+Generates a synthetic input file and times the different phases of ipa
+against it. The results are printed in json format, so they can be saved
+and compared between releases.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+from ruamel.yaml import YAML
+
+from allocation import ip_to_str
+import ipa
+from subnet import IPPool, IpRangeAllocator
+
+
+def generate_input(nodes=1000, entries=3, schemas=10, ranges=True,
+                   vlans=True, ipv6=True, sites=1):
+    """Generate a synthetic input file in yaml format
+
+    Each node uses one of the schemas (by yaml anchor), so the schemas are
+    shared by many nodes, as in real inputs. The subnets are allocated from
+    an IPv4 /8 and an IPv6 /32 root, through nested 'from' subnets.
+
+    :param nodes: the number of ipam nodes
+    :param entries: the number of subnet entries per schema (and per node);
+        /29, /30 and /32 subnets are used in turn
+    :param schemas: the number of schemas in ip_allocation_schemas
+    :param ranges: add 'size' ranges to each node (one from a subnet of the
+        node and one from a shared subnet)
+    :param vlans: allocate a VLAN for the /29 and /30 subnets
+    :param ipv6: add an IPv6 /64 subnet to each node
+    :param sites: the number of sites, each with its own root subnets and
+        VLAN pool (i.e. independent groups of entries); the nodes are
+        spread over the sites
+    :return: the content of the input file as string
+    """
+    def site(i):
+        # the suffix of the subnets and pools of a site
+        return '_{}'.format(i) if sites > 1 else ''
+
+    lines = ["subnet:"]
+    for i in range(sites):
+        lines.extend([
+            "  net1{0}: {{cidr: {1}.0.0.0/8}}".format(site(i), 10 + i),
+            "  main_net{0}: {{from: net1{0}, prefixlen: 10}}".format(site(i)),
+            "  link_net{0}: {{from: main_net{0}, prefixlen: 11}}"
+            .format(site(i)),
+            "  shared_net{0}: {{from: net1{0}, prefixlen: 16}}"
+            .format(site(i)),
+            "  net6{0}: {{cidr: '2001:{1:x}::/32'}}"
+            .format(site(i), 0xdb8 + i),
+            "  main_net6{0}: {{from: net6{0}, prefixlen: 40}}"
+            .format(site(i)),
+        ])
+    lines.extend(["", "vlan_pool:"])
+    for i in range(sites):
+        lines.append("  pool1{0}: {{start: 1, end: 4095}}".format(site(i)))
+    lines.extend([
+        "",
+        "ip_allocation_schemas:",
+        "  - &shared",
+        "    - {name: pool_net, prefixlen: 16, label: linknet}",
+    ])
+    prefixlens = [(29, 'linknet'), (30, 'linknet'), (32, 'vip')]
+    for i in range(schemas):
+        lines.append("  - &schema_{}".format(i))
+        for j in range(entries):
+            prefixlen, label = prefixlens[j % len(prefixlens)]
+            lines.append(
+                "    - {{name: net_{}, prefixlen: {}, label: {}, "
+                "properties: {{desc: schema {} net {}}}}}"
+                .format(j, prefixlen, label, i, j))
+        if ipv6:
+            lines.append("    - {name: net6, prefixlen: 64, label: v6}")
+        if ranges:
+            lines.extend([
+                "    - {name: local_range, size: 2, label: local}",
+                "    - {name: shared_range, size: 1, label: shared}",
+            ])
+
+    lines.extend(["", "ipam:"])
+    for i in range(sites):
+        lines.append(
+            "  shared{0}: {{schema: *shared, "
+            "subnet: {{linknet: shared_net{0}}}}}".format(site(i)))
+    for i in range(nodes):
+        suffix = site(i % sites)
+        parts = [
+            "schema: *schema_{}".format(i % schemas),
+            "subnet: {{linknet: link_net{0}, vip: main_net{0}, "
+            "v6: main_net6{0}}}".format(suffix),
+        ]
+        if ranges:
+            parts.append(
+                "ip_range: {{local: .net_0, shared: shared{0}.pool_net}}"
+                .format(suffix))
+        if vlans:
+            parts.append("vlan_pool: {{linknet: pool1{0}}}".format(suffix))
+        lines.append("  node_{}: {{{}}}".format(i, ", ".join(parts)))
+    return "\n".join(lines) + "\n"
+
+
+def best_of(func, setup=None, repeat=3):
+    """Run func (with the result of setup, if specified) and return the
+    best time in seconds; setup is not timed"""
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        start = timeit.default_timer()
+        func(arg) if setup is not None else func()
+        times.append(timeit.default_timer() - start)
+    return min(times)
+
+
+def ipv6_prefixlens(prefixes):
+    """The prefixlens of an IPv6 plan with the given number of prefixes:
+    mostly /64s, with a /56 every 100 prefixes and a /48 every 1000"""
+    return [48 if i % 1000 == 0 else 56 if i % 100 == 0 else 64
+            for i in range(prefixes)]
+
+
+def bench_ipv6(prefixes=100000, repeat=3):
+    """Time the allocation of many IPv6 prefixes from a /32 and of big
+    IP ranges from a /64
+
+    :param prefixes: the number of prefixes
+    :param repeat: the number of runs per benchmark
+    :return: dict with the times per benchmark
+    """
+    prefixlens = ipv6_prefixlens(prefixes)
+    ranges = max(prefixes // 10, 1)
+
+    def alloc_ranges(_):
+        ipr = IpRangeAllocator('2001:db8::/64')
+        for i in range(ranges):
+            ipr.alloc_interval(1 << 40, from_the_back=bool(i % 2))
+
+    return {
+        'ipv6_allocate_blocks': best_of(
+            lambda ipp: ipp.allocate_blocks(prefixlens),
+            lambda: IPPool('2001:db8::/32'), repeat=repeat),
+        'ipv6_allocate_subnets': best_of(
+            lambda ipp: ipp.allocate_subnets(prefixlens),
+            lambda: IPPool('2001:db8::/32'), repeat=repeat),
+        'ipv6_format': best_of(
+            lambda firsts: [ip_to_str(x, 6) for x in firsts],
+            lambda: IPPool('2001:db8::/32').allocate_blocks(prefixlens),
+            repeat=repeat),
+        'ipv6_alloc_ranges': best_of(alloc_ranges, lambda: None,
+                                     repeat=repeat),
+    }
+
+
+def run(nodes=1000, entries=3, repeat=3, new_nodes=None, sites=1, jobs=1,
+        ipv6_prefixes=100000):
+    """Run all the benchmarks
+
+    :param nodes: the number of ipam nodes of the generated input
+    :param entries: the number of subnet entries per node
+    :param repeat: the number of runs per benchmark
+    :param new_nodes: the number of nodes added since the previous allocation
+        (for the benchmarks with a previous allocation). Default: 1%
+    :param sites: the number of sites (independent root subnets and VLAN
+        pools) of the generated input
+    :param jobs: if more than 1, also time alloc_ips with this number of
+        processes
+    :param ipv6_prefixes: the number of prefixes for the IPv6 benchmarks
+        (see bench_ipv6()); 0 to skip them
+    :return: dict with the parameters and the times per benchmark
+    """
+    if new_nodes is None:
+        new_nodes = max(nodes // 100, 1)
+
+    content = generate_input(nodes, entries, sites=sites)
+    d = ipa.load_input(content)
+
+    # create the previous allocation, without the new nodes
+    d_prev = ipa.load_input(
+        generate_input(nodes - new_nodes, entries, sites=sites))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        prev_json = os.path.join(tmp_dir, 'previous.json')
+        prev_snapshot = os.path.join(tmp_dir, 'previous.snapshot')
+        with open(prev_json, 'w') as f:
+            ipa.write_output(ipa.alloc_ips(d_prev, {}), 'json', f)
+        with open(prev_snapshot, 'wb') as f:
+            ipa.write_output(ipa.alloc_ips(d_prev, {}), 'snapshot', f)
+
+        res = {
+            'load_input': best_of(
+                lambda: ipa.load_input(content), repeat=repeat),
+            'load_input_round_trip': best_of(
+                lambda: YAML().load(content), repeat=repeat),
+            'convert_subnets': best_of(
+                lambda: ipa.convert_subnets(d), repeat=repeat),
+            'filter_entries': best_of(
+                lambda: ipa.filter_entries(d, {}), repeat=repeat),
+            'alloc_ips': best_of(
+                lambda: ipa.alloc_ips(d, {}), repeat=repeat),
+            'load_previous_json': best_of(
+                lambda: ipa.load_previous(prev_json), repeat=repeat),
+            'load_previous_snapshot': best_of(
+                lambda: ipa.load_previous(prev_snapshot), repeat=repeat),
+            'filter_entries_with_previous': best_of(
+                lambda p: ipa.filter_entries(d, p),
+                lambda: ipa.load_previous(prev_json), repeat=repeat),
+            'alloc_ips_with_previous': best_of(
+                lambda p: ipa.alloc_ips(d, p),
+                lambda: ipa.load_previous(prev_json), repeat=repeat),
+            'alloc_ips_with_previous_resume': best_of(
+                lambda p: ipa.alloc_ips(d, p, resume=True),
+                lambda: ipa.load_previous(prev_json), repeat=repeat),
+        }
+
+        # a run with the cache of a run with the same input and previous
+        # allocation: all the groups of entries are reused
+        cache = {}
+        ipa.alloc_ips(d, ipa.load_previous(prev_json), cache=cache)
+        res['alloc_ips_with_previous_cached'] = best_of(
+            lambda p: ipa.alloc_ips(d, p, cache=dict(cache)),
+            lambda: ipa.load_previous(prev_json), repeat=repeat)
+
+        if ipv6_prefixes:
+            res.update(bench_ipv6(ipv6_prefixes, repeat))
+
+        if jobs > 1:
+            res['alloc_ips_parallel'] = best_of(
+                lambda: ipa.alloc_ips(d, {}, jobs=jobs), repeat=repeat)
+
+        # the output functions modify the result of alloc_ips
+        # so a new one is created (untimed) for every run
+        for output_format in ['json', 'human', 'yaml-anchors', 'snapshot']:
+            mode = 'wb' if output_format == 'snapshot' else 'w'
+            with open(os.devnull, mode) as f:
+                res['output_' + output_format] = best_of(
+                    lambda r: ipa.write_output(r, output_format, f),
+                    lambda: ipa.alloc_ips(d, {}), repeat=repeat)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return {
+        'params': {
+            'nodes': nodes,
+            'entries': entries,
+            'new_nodes': new_nodes,
+            'sites': sites,
+            'jobs': jobs,
+            'ipv6_prefixes': ipv6_prefixes,
+            'repeat': repeat,
+            'input_size': len(content),
+        },
+        'python': platform.python_version(),
+        'results': res,
+    }
+
+
+def main(input_args):
+    parser = argparse.ArgumentParser(description='ipa benchmarks')
+    parser.add_argument('--nodes', type=int, default=1000,
+                        help='the number of ipam nodes. Default: 1000')
+    parser.add_argument('--entries', type=int, default=3,
+                        help='the number of subnet entries per node. '
+                             'Default: 3')
+    parser.add_argument('--new-nodes', type=int, default=None,
+                        help='the number of nodes added since the previous '
+                             'allocation. Default: 1%% of the nodes')
+    parser.add_argument('--sites', type=int, default=1,
+                        help='the number of sites, each with its own root '
+                             'subnets and VLAN pool. Default: 1')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='also time the allocation with this number of '
+                             'processes (if more than 1). Default: 1')
+    parser.add_argument('--ipv6-prefixes', type=int, default=100000,
+                        help='the number of prefixes allocated from an '
+                             'IPv6 /32 in the IPv6 benchmarks (0 to skip '
+                             'them). Default: 100000')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='the number of runs per benchmark (the best '
+                             'one is reported). Default: 3')
+    parser.add_argument('--output',
+                        dest="output_file",
+                        metavar="FILE",
+                        help='write the results to FILE instead of stdout')
+    args = parser.parse_args(input_args)
+
+    res = json.dumps(run(args.nodes, args.entries, args.repeat,
+                         args.new_nodes, args.sites, args.jobs,
+                         args.ipv6_prefixes),
+                     indent=2, sort_keys=True)
+    if args.output_file:
+        with open(args.output_file, 'w') as f:
+            f.write(res + '\n')
+    else:
+        return res
+
+
+if __name__ == "__main__":
+    res = main(sys.argv[1:])
+    if res is not None:
+        print(res)
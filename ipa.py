@@ -1,20 +1,41 @@
 #!/usr/bin/env python
 
 from collections import OrderedDict
+import hashlib
 import json
 import argparse
+import multiprocessing
+import os
 import sys
 from ruamel.yaml import YAML
+from ruamel.yaml.constructor import SafeConstructor
+from ruamel.yaml.error import MarkedYAMLError
 from subnet import *
-import copy
-
-
-def main(input_args):
+from allocation import Allocation
+import snapshot
+import store
+from stats import Stats, NO_STATS
+from functools import partial
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+def main(input_args, out=None, stats=None):
+    """Run ipa with the given command line arguments
+
+    If an output stream is given (or --output is used), the result is
+    written to it as it is generated; otherwise it is returned.
+    If a Stats object is given, the timing and allocation statistics of
+    the run are collected in it (see also --stats).
+    """
     parser = argparse.ArgumentParser(description='Basic IPAM tool')
     parser.add_argument(dest="input_file",
                         help='the input file in yaml format')
 
-    output_formats = ['human', 'json', 'yaml-anchors', 'internal']
+    output_formats = ['human', 'json', 'yaml-anchors', 'internal', 'snapshot',
+                      'diff', 'report']
     parser.add_argument('-o',
                         dest="output_format",
                         default="human",
@@ -28,7 +49,7 @@ def main(input_args):
                        dest="previous_alloc",
                        metavar="FILE.json",
                        help='the result of a previous run/allocation, '
-                            'in json format.')
+                            'in json or snapshot format.')
 
     group.add_argument('--first-run',
                        dest="is_first_run",
@@ -38,48 +59,220 @@ def main(input_args):
                             "no previous ip allocations that have to be "
                             "preserved)")
 
-    parser.add_argument('--version', action='version', version='1.0')
+    group.add_argument('--store',
+                       dest="store",
+                       metavar="FILE.db",
+                       help='use the allocation in the SQLite database '
+                            'FILE.db (created if needed) as the previous '
+                            'allocation and save the result in it')
 
-    args = parser.parse_args(input_args)
+    group.add_argument('--preflight',
+                       dest="preflight",
+                       action="store_true",
+                       help="only check that the subnets, VLANs and IP "
+                            "ranges of the input fit in their pools, without "
+                            "allocating them, and exit with an error listing "
+                            "all the shortfalls if they do not")
+
+    parser.add_argument('--resume',
+                        dest="resume",
+                        action="store_true",
+                        help="restore the IP and VLAN pools from the "
+                             "previous allocation (-p) and only allocate the "
+                             "new entries, instead of allocating the old "
+                             "entries again")
+
+    parser.add_argument('--output',
+                        dest="output_file",
+                        metavar="FILE",
+                        help='write the output to FILE instead of stdout')
+
+    parser.add_argument('--cache',
+                        dest="cache_file",
+                        metavar="FILE.json",
+                        help='reuse the allocation of the groups of entries '
+                             'whose input did not change since the run '
+                             'which saved FILE.json, then save the groups '
+                             'of this run in it (created if needed)')
+
+    parser.add_argument('-j', '--jobs',
+                        dest="jobs",
+                        type=int,
+                        default=1,
+                        help='the number of processes used to allocate the '
+                             'entries of independent IP and VLAN pools in '
+                             'parallel. Default: 1')
+
+    parser.add_argument('--stats',
+                        dest="stats_format",
+                        nargs='?',
+                        const='text',
+                        choices=['text', 'json'],
+                        help='print the time spent in each phase and the '
+                             'allocation statistics to stderr, as text '
+                             '(default) or json. With -j, the phases of the '
+                             'processes are added up in alloc_parallel/*')
 
-    yaml = YAML()
-    with open(args.input_file) as f:
-        input_dict = yaml.load(f)
+    parser.add_argument('--version', action='version', version='1.0')
 
-    palloc = {}
-    if args.previous_alloc:
-        with open(args.previous_alloc) as f:
-            palloc = objectify(json.load(f))
+    args = parser.parse_args(input_args)
 
-    res = alloc_ips(input_dict, palloc)
+    if args.resume and not (args.previous_alloc or args.store):
+        parser.error("--resume requires a previous allocation "
+                     "(-p or --store)")
+
+    if args.output_format == 'snapshot' and not args.output_file:
+        parser.error("the snapshot output requires an output file (--output)")
+
+    if stats is None:
+        stats = Stats() if args.stats_format else NO_STATS
+
+    try:
+        return run(args, out, stats)
+    finally:
+        if args.stats_format:
+            sys.stderr.write((stats.to_json() if args.stats_format == 'json'
+                              else stats.to_text()) + '\n')
+
+
+def run(args, out, stats):
+    """Run ipa with the parsed command line arguments (see main())"""
+    with stats.phase('load_input'):
+        with open(args.input_file) as f:
+            input_dict = load_input(f)
+
+    if args.preflight:
+        with stats.phase('preflight'):
+            shortfalls = preflight(input_dict)
+        if shortfalls:
+            sys.exit("\n".join(shortfalls))
+        return None if out is not None else ''
+
+    cache = None
+    if args.cache_file:
+        with stats.phase('load_cache'):
+            cache = load_cache(args.cache_file)
+
+    # the previous allocation, with the pools as dicts (for the diff)
+    previous = {}
+    # the IP range allocators (for the report)
+    ip_ranges = {}
+    if args.store:
+        res = alloc_ips_with_store(input_dict, args.store, args.resume, stats,
+                                   args.jobs, previous, cache, ip_ranges)
+    else:
+        palloc = {}
+        if args.previous_alloc:
+            palloc = load_previous(args.previous_alloc, stats)
+            if args.output_format == 'diff':
+                previous = pools_to_dicts(palloc)
+        res = alloc_ips(input_dict, palloc, args.resume, stats, args.jobs,
+                        ip_ranges, cache)
+
+    if cache is not None:
+        with stats.phase('save_cache'):
+            save_cache(cache, args.cache_file)
+
+    with stats.phase('output'):
+        report = None
+        if args.output_format == 'report':
+            report = pool_report(res, ip_ranges,
+                                 requested_prefixlens(input_dict))
+
+        if args.output_file:
+            mode = 'wb' if args.output_format == 'snapshot' else 'w'
+            with open(args.output_file, mode) as f:
+                write_output(res, args.output_format, f, previous, report)
+            return
+        elif out is not None:
+            write_output(res, args.output_format, out, previous, report)
+            return
+
+        if args.output_format == 'json':
+            f = StringIO()
+            write_json(res, f)
+            return f.getvalue()
+        elif args.output_format == 'yaml-anchors':
+            return to_yaml_anchors(res)
+        elif args.output_format == 'human':
+            return to_human(res)
+        elif args.output_format == 'diff':
+            f = StringIO()
+            write_diff(res, previous, f)
+            return f.getvalue()
+        elif args.output_format == 'report':
+            f = StringIO()
+            write_report(report, f)
+            return f.getvalue()
+        elif args.output_format == 'internal':
+            return res
+
+
+class OrderedSafeConstructor(SafeConstructor):
+    """A SafeConstructor that keeps the order of the keys in the mappings
+    (the order of the subnets, nodes and entries matters for allocation)"""
+
+    def __init__(self, *args, **kwargs):
+        SafeConstructor.__init__(self, *args, **kwargs)
+        self.yaml_base_dict_type = OrderedDict
+
+
+def load_input(f, round_trip=False):
+    """Load the input file
+
+    By default the safe loader is used, with the C parser if available,
+    which is a lot faster than the round-trip loader on big files.
+    The C parser only supports YAML 1.1 so if it fails, the input is
+    parsed again with the pure python parser.
+    The round-trip loader should only be used if the comments and the
+    formatting of the input have to be preserved.
+
+    :param f: the input file (or the content as string)
+    :param round_trip: use the round-trip loader
+    :return: the content of the input file as dict
+    """
+    if round_trip:
+        return YAML().load(f)
 
-    if args.output_format == 'json':
-        return json.dumps(deobjectify(res), indent=2)
-    elif args.output_format == 'yaml-anchors':
-        return to_yaml_anchors(res)
-    elif args.output_format == 'human':
-        return to_human(res)
-    elif args.output_format == 'internal':
-        return res
+    content = f.read() if hasattr(f, 'read') else f
+    try:
+        yaml = YAML(typ='safe')
+        yaml.Constructor = OrderedSafeConstructor
+        return yaml.load(content)
+    except MarkedYAMLError:
+        yaml = YAML(typ='safe', pure=True)
+        yaml.Constructor = OrderedSafeConstructor
+        return yaml.load(content)
 
 
-def convert_subnets(d):
+def convert_subnets(d, restored=None):
     # convert the input subnets into IPPools
     # input subnets can also be created dynamically from another subnet
     # in that case a 'prefixlen' and a 'from' subnet should be provided
+    # the subnets found in 'restored' (e.g. restored from a previous
+    # allocation) are copied instead of being created again
+    restored = restored or {}
     acc = {}
-    pools = netaddr.IPSet()
+
+    # the root subnets, as ((version, first IP), (version, last IP), input
+    # index, cidr), checked for overlaps once they are all converted
+    roots = []
 
     def convert_subnet(k):
         v = d['subnet'][k]
         if 'cidr' in v:
-            ipp = IPPool(v['cidr'])
-            assert not pools.intersection(ipp.pool),\
-                "Subnet {} is overlapping with previous subnets"\
-                .format(v['cidr'])
-            pools.update(ipp.pool)
+            ipp = restored[k].copy() if k in restored else IPPool(v['cidr'])
+            net = ipp.initial_net
+            assert net == netaddr.IPNetwork(v['cidr']),\
+                "Subnet {} does not match the previous allocation {}"\
+                .format(v['cidr'], net)
+            roots.append(((net.version, net.first), (net.version, net.last),
+                          len(roots), v['cidr']))
             acc[k] = ipp
 
+        elif k in restored:
+            acc[k] = restored[k].copy()
+
         elif 'from' in v:
             parent = acc.get(v['from'])
             if parent is None:
@@ -91,119 +284,590 @@ def convert_subnets(d):
     for k_ in d['subnet']:
         convert_subnet(k_)
 
+    # sweep the roots sorted by address: a root overlaps another one if it
+    # starts before the end of the root reaching the farthest so far
+    roots.sort()
+    overlaps = []
+    farthest = None
+    for root in roots:
+        if farthest is not None and root[0] <= farthest[1]:
+            overlaps.append(sorted([farthest, root], key=lambda x: x[2]))
+        if farthest is None or root[1] > farthest[1]:
+            farthest = root
+    if overlaps:
+        # the first one in the input order
+        prev, root = min(overlaps, key=lambda x: x[1][2])
+        raise AssertionError(
+            "Subnet {} is overlapping with previous subnet {}"
+            .format(root[3], prev[3]))
+
     return acc
 
 
 class VlanPool(object):
+    """A pool of VLAN ids, from first (inclusive) to last (exclusive)
+
+    The used VLANs are kept as a bitmap in an int (bit i is set if VLAN
+    first + i is used), so a pool is cheap to create and to copy, whatever
+    the size of its VLAN range. The number of runs of free VLANs of each
+    length is kept up to date on each change, for the fragmentation
+    counters.
+    """
 
     def __init__(self, first, last):
         self.first = first
         self.last = last
-        self.pool = iter(range(first, last))
+        self._used = 0
+        self._mask = (1 << max(last - first, 0)) - 1
+        # the number of VLANs in the pool
+        self.size = max(last - first, 0)
+        # the number of free VLANs, kept up to date on each change
+        self.free_size = self.size
+        # the number of VLANs allocated
+        self.allocations = 0
+        # length -> the number of runs of free VLANs of that length
+        self._runs = {self.size: 1} if self.size else {}
+        # the number of runs of free VLANs and the length of the longest
+        self.free_fragments = len(self._runs)
+        self.largest_free_size = self.size
 
     def alloc(self):
-        return next(self.pool)
+        """Allocate the lowest free VLAN
+
+        :raises: SubnettingError if there is no free VLAN in the pool
+        """
+        if not self.free_size:
+            raise SubnettingError(
+                "No free VLAN left in the VLAN pool {0}-{1}"
+                .format(self.first, self.last))
+        # the lowest zero bit of the bitmap
+        i = ((self._used + 1) & ~self._used).bit_length() - 1
+        self._take(i)
+        self.allocations += 1
+        return self.first + i
+
+    def _take(self, i):
+        """Mark the free VLAN first + i as used"""
+        used = self._used
+        # the run of free VLANs [start, end) containing i: it starts after
+        # the highest used bit below i and ends at the lowest used bit (or
+        # the end of the pool) above i
+        start = (used & ((1 << i) - 1)).bit_length()
+        above = (used | ~self._mask) >> (i + 1)
+        end = i + (above & -above).bit_length()
+        self._used = used | 1 << i
+        self.free_size -= 1
+
+        runs = self._runs
+        length = end - start
+        runs[length] -= 1
+        if not runs[length]:
+            del runs[length]
+        self.free_fragments -= 1
+        for x in (i - start, end - i - 1):
+            if x:
+                runs[x] = runs.get(x, 0) + 1
+                self.free_fragments += 1
+        # the runs only get shorter, until set_unused()
+        while self.largest_free_size and \
+                self.largest_free_size not in runs:
+            self.largest_free_size -= 1
+
+    def _count_runs(self):
+        self._runs = {}
+        for start, end in self.free_ranges():
+            self._runs[end - start] = self._runs.get(end - start, 0) + 1
+        self.free_fragments = sum(self._runs.values())
+        self.largest_free_size = max(self._runs) if self._runs else 0
+
+    def copy(self):
+        """Return a copy of the pool, which can be allocated from without
+        changing this one"""
+        res = VlanPool.__new__(VlanPool)
+        res.__dict__.update(self.__dict__)
+        res._runs = dict(self._runs)
+        return res
 
-    def unused(self):
-        u = list(self.pool)
-        return u[0], u[-1] + 1
+    def reserve(self, vid):
+        """Mark the given VLAN as used
+
+        :raises: ValueError if the VLAN is not free in the pool
+        """
+        if not self.first <= vid < self.last or self.is_allocated(vid):
+            raise ValueError("VLAN {0} is not free in the VLAN pool {1}-{2}"
+                             .format(vid, self.first, self.last))
+        self._take(vid - self.first)
 
+    def is_allocated(self, vid):
+        return self.first <= vid < self.last and \
+            bool(self._used >> (vid - self.first) & 1)
 
-def convert_vlans(d):
+    def free_ranges(self):
+        """The free VLANs as a list of [start, end) ranges"""
+        return bits_to_ranges(~self._used & self._mask, self.first)
+
+    @property
+    def used_size(self):
+        """The number of allocated VLANs"""
+        return self.size - self.free_size
+
+    def unused(self):
+        """The free VLANs, as a single [start, end) range if they are all at
+        the end of the pool (e.g. the VLANs were only allocated), or as a
+        list of [start, end) ranges otherwise"""
+        ranges = self.free_ranges()
+        if not ranges:
+            return self.last, self.last
+        if len(ranges) == 1 and ranges[0][1] == self.last:
+            return tuple(ranges[0])
+        return ranges
+
+    def set_unused(self, unused):
+        """Mark all the VLANs as used, except the given ones (in the format
+        returned by unused())"""
+        if unused and not isinstance(unused[0], (list, tuple)):
+            unused = [unused]
+        free = 0
+        for start, end in unused:
+            free |= ((1 << (end - start)) - 1) << (start - self.first)
+        self._used = ~free & self._mask
+        self.free_size = bin(free & self._mask).count('1')
+        self._count_runs()
+
+
+def bits_to_ranges(bits, first):
+    """Convert a bitmap of VLANs (bit i is set for VLAN first + i) to a
+    list of [start, end) ranges"""
+    res = []
+    while bits:
+        # the start of the run of VLANs: the lowest set bit
+        start = (bits & -bits).bit_length() - 1
+        # the length of the run: the lowest zero bit after it
+        x = bits >> start
+        length = ((x + 1) & ~x).bit_length() - 1
+        res.append([first + start, first + start + length])
+        bits &= ~(((1 << length) - 1) << start)
+    return res
+
+
+def convert_vlans(d, restored=None):
     # TODO: add some validation
-    return {k: VlanPool(v['start'], v['end'])
-            for k, v in d['vlan_pool'].items()}
+    # the vlan pools found in 'restored' (e.g. restored from a previous
+    # allocation) are copied instead of being created again
+    restored = restored or {}
+    acc = {}
+    for k, v in d['vlan_pool'].items():
+        vp = restored[k].copy() if k in restored else \
+            VlanPool(v['start'], v['end'])
+        assert (vp.first, vp.last) == (v['start'], v['end']),\
+            "VLAN pool {} does not match the previous allocation"\
+            .format(k)
+        acc[k] = vp
+    return acc
+
 
+def preflight(d):
+    """Check that the subnets, VLANs and IP ranges requested by the input
+    fit in their pools, without allocating them
 
-def alloc_ips(d, p):
+    The demand is added up per pool from the schemas: the subnets of each
+    prefixlen (and the 'from' subnets) per IP pool, the VLANs per VLAN pool
+    and the sizes of the IP ranges per parent entry. The subnets are
+    aligned blocks allocated by a buddy allocator, so they fit in an IP
+    pool as long as none is bigger than the pool and their total size is
+    not bigger than the pool; the IP ranges fit in the usable IPs of their
+    parent subnet as long as their total size does. The input is checked
+    as for a first run (the previous allocations are not used).
+
+    :param d: the content of the input file as dict
+    :return: the list of the shortfalls (and invalid references) found,
+        as messages; empty if the input fits
+    """
+    res = []
+    subnets = d.get('subnet', {})
+    vlan_pools = d.get('vlan_pool', {})
+    # the messages of the pools referenced by the nodes which do not exist
+    # (reported once per node)
+    missing = set()
+
+    # the (IP version, prefixlen) of each IP pool
+    pools = {}
+
+    def pool_prefixlen(k, seen=()):
+        if k not in pools:
+            v = subnets[k]
+            if 'cidr' in v:
+                net = netaddr.IPNetwork(v['cidr'])
+                pools[k] = (net.version, net.prefixlen)
+            else:
+                assert v['from'] not in seen + (k,), \
+                    "Subnet {} is created from itself".format(k)
+                pools[k] = (pool_prefixlen(v['from'], seen + (k,))[0],
+                            v['prefixlen'])
+        return pools[k]
+
+    # the number of subnets of each prefixlen requested from each IP pool
+    demand = dict((k, {}) for k in subnets)
+    vlans = dict((k, 0) for k in vlan_pools)
+    # the total size of the IP ranges of each parent entry
+    ranges = OrderedDict()
+    # the (IP pool, prefixlen) of each subnet entry
+    entries = {}
+
+    for k, v in subnets.items():
+        if 'from' in v:
+            if v['from'] not in subnets:
+                res.append("Subnet {}: subnet {} does not exist"
+                           .format(k, v['from']))
+                continue
+            counts = demand[v['from']]
+            counts[v['prefixlen']] = counts.get(v['prefixlen'], 0) + 1
+
+    for node_k, v in d['ipam'].items():
+        try:
+            program = compile_schema(v)
+        except KeyError as e:
+            res.append("Node {}: label {} has no pool".format(node_k, e))
+            continue
+        except AssertionError as e:
+            res.append("Node {}: {}".format(node_k, e))
+            continue
+
+        for s, (subnet, vlan_pool, parent) in zip(v['schema'], program):
+            if parent is not None:
+                parent = (parent[0] or node_k, parent[1])
+                ranges[parent] = ranges.get(parent, 0) + abs(s['size'])
+                continue
+            if subnet not in subnets:
+                msg = "Node {}: subnet {} does not exist".format(node_k,
+                                                                 subnet)
+                if msg not in missing:
+                    missing.add(msg)
+                    res.append(msg)
+                continue
+            counts = demand[subnet]
+            counts[s['prefixlen']] = counts.get(s['prefixlen'], 0) + 1
+            entries[(node_k, s['name'])] = (subnet, s['prefixlen'])
+            if vlan_pool is None:
+                continue
+            if vlan_pool not in vlan_pools:
+                msg = "Node {}: VLAN pool {} does not exist".format(
+                    node_k, vlan_pool)
+                if msg not in missing:
+                    missing.add(msg)
+                    res.append(msg)
+                continue
+            vlans[vlan_pool] += 1
+
+    for k in sorted(demand):
+        counts = demand[k]
+        if not counts:
+            continue
+        try:
+            version, prefixlen = pool_prefixlen(k)
+        except (KeyError, AssertionError):
+            # reported with the 'from' subnets
+            continue
+        width = 32 if version == 4 else 128
+        too_big = [x for x in counts if x < prefixlen]
+        if too_big:
+            res.append("IP pool {}: /{} requested from a /{}"
+                       .format(k, min(too_big), prefixlen))
+            continue
+        requested = sum(n << (width - x) for x, n in counts.items())
+        if requested > 1 << (width - prefixlen):
+            res.append("IP pool {}: {} IPs requested ({}), {} available"
+                       .format(k, requested,
+                               ", ".join("/{} x {}".format(x, counts[x])
+                                         for x in sorted(counts)),
+                               1 << (width - prefixlen)))
+
+    for k in sorted(vlans):
+        v = vlan_pools[k]
+        if vlans[k] > v['end'] - v['start']:
+            res.append("VLAN pool {}: {} VLANs requested, {} available"
+                       .format(k, vlans[k], max(v['end'] - v['start'], 0)))
+
+    for k, requested in ranges.items():
+        if k not in entries:
+            res.append("IP range {}: the parent entry does not exist or is "
+                       "not a subnet".format('.'.join(k)))
+            continue
+        subnet, prefixlen = entries[k]
+        try:
+            version = pool_prefixlen(subnet)[0]
+        except (KeyError, AssertionError):
+            continue
+        size = 1 << ((32 if version == 4 else 128) - prefixlen)
+        # see new_range_allocator()
+        available = max(size - 3 if size >= 4 else size - 2, 0)
+        if requested > available:
+            res.append("IP range {}: {} IPs requested, {} available"
+                       .format('.'.join(k), requested, available))
+
+    return res
+
+
+def alloc_ips(d, p, resume=False, stats=NO_STATS, jobs=1, ip_ranges=None,
+              cache=None):
     """Allocate IPs
     :param d: the content of the input file as dict
     :param p: the result of a previous allocation as dict
+    :param resume: if True, restore the IP and VLAN pools from the previous
+        allocation and reuse its entries instead of allocating them again
+    :param stats: a Stats object to collect the timing and allocation
+        statistics in
+    :param jobs: the number of processes used to allocate the independent
+        groups of entries (see partition_entries()); 1 to allocate all the
+        entries in this process
+    :param ip_ranges: if given, a dict which is filled with the
+        IpRangeAllocator of each parent entry of an IP range (e.g. to
+        allocate more IP ranges later, see alloc_entries())
+    :param cache: if given, the allocation of the groups of entries of a
+        previous run (see alloc_entries_cached()), which is reused for the
+        groups whose input did not change and updated with the groups of
+        this run
     :return: dict
     """
-    tmp = {}
+    with stats.phase('convert_pools'):
+        if resume:
+            vp = convert_vlans(d, p['vlan_pool'])
+            ipp = convert_subnets(d, p['ip_pool'])
+        else:
+            vp = convert_vlans(d)
+            ipp = convert_subnets(d)
+
+    with stats.phase('filter_entries'):
+        old, new = filter_entries(d, p)
+
+    if cache is not None:
+        tmp, ipr = alloc_entries_cached(d, p, ipp, vp, old, new, resume,
+                                        cache, stats, jobs)
+    elif jobs > 1:
+        tmp, ipr = alloc_entries_parallel(d, p, ipp, vp, old, new, resume,
+                                          jobs, stats)
+    else:
+        tmp, ipr = alloc_entries(d, p, ipp, vp, old, new, resume, stats)
+
+    # create the final data structure
+    with stats.phase('build_result'):
+        res = OrderedDict()
+
+        for k, v in d['ipam'].items():
+            res[k] = {'properties': v.get('properties', {}),
+                      'ipa': OrderedDict()}
+            for s in v['schema']:
+                res[k]['ipa'][s['name']] = tmp[(k, s['name'])]
+
+    stats.add_pools(ipp, ipr, vp)
+    if ip_ranges is not None:
+        ip_ranges.update(ipr)
+
+    r = {
+        'ipam': res,
+        'ip_pool': ipp,
+        'vlan_pool': vp,
+    }
+    # pass along any global properties
+    if d.get('properties'):
+        r['properties'] = d['properties']
+    return r
+
 
-    vp = convert_vlans(d)
-    ipp = convert_subnets(d)
-    ipr = {}  # keep track of the IP ranges per subnet
+def alloc_ips_with_store(d, path, resume=False, stats=NO_STATS, jobs=1,
+                         previous=None, cache=None, ip_ranges=None):
+    """Allocate IPs using the allocation saved in a store as the previous
+    allocation, and save the result in the store (see store.py)
+
+    Only the nodes and the pools of the input are loaded and saved, in a
+    single transaction.
+
+    :param d: the content of the input file as dict
+    :param path: the store
+    :param previous: if given, a dict which is filled with the previous
+        allocation loaded from the store, with the pools as dicts
+    :return: the same as alloc_ips()
+    """
+    db = store.Store(path)
+    try:
+        with db.transaction():
+            with stats.phase('load_previous'):
+                p = db.load(d['ipam'], d.get('subnet', {}),
+                            d.get('vlan_pool', {}))
+                if previous is not None:
+                    previous.update(p)
+            with stats.phase('objectify'):
+                objectify_pools(p)
+
+            res = alloc_ips(d, p, resume, stats, jobs, ip_ranges, cache)
+
+            with stats.phase('save_store'):
+                db.save(pools_to_dicts(res))
+    finally:
+        db.close()
+    return res
+
+
+def compile_schema(v):
+    """Resolve the labels of the entries of an ipam node
+
+    :param v: the ipam node
+    :return: a list with, for each entry of the schema of the node, a
+        (subnet name, VLAN pool name, parent) tuple, where parent is the
+        (node, entry name) key to the parent entry of an IP range entry
+        (with an empty node name for the current node) or None
+    """
+    subnets = v.get('subnet', {})
+    vlan_pools = v.get('vlan_pool', {})
+    ip_ranges = v.get('ip_range', {})
+    program = []
+    for s in v['schema']:
+        if 'size' in s:
+            parent_str = ip_ranges[s['label']]
+            parent = parent_str.split('.')
+            assert len(parent) == 2,\
+                "'{}' does not have the expected format (<node>.<entry> " \
+                "or .<entry>)".format(parent_str)
+            program.append((None, None, tuple(parent)))
+        else:
+            program.append((subnets[s['label']], vlan_pools.get(s['label']),
+                            None))
+    return program
+
+
+def entry_metadata(s, parent=None):
+    """The metadata set on an entry when it is allocated
+
+    :param s: the entry
+    :param parent: the key to the parent entry, for an ip range entry
+    """
+    if parent is None:
+        return {'type': 'subnet', 'label': s['label']}
+    return {'type': 'ip_range', 'parent': parent, 'label': s['label']}
 
-    def run_for(input_):
+
+def new_range_allocator(parent):
+    """Create the IpRangeAllocator for the IP ranges of the given
+    (Allocation of a) subnet entry"""
+    net = parent.cidr
+    # make sure the last IP is not used
+    # so that it can be used for the gateway
+    # start the ip range from -3 as -2 is the last usable ip
+    eidx = -3 if net.size >= 4 else -2
+    return IpRangeAllocator(net, end_index=eidx)
+
+
+def alloc_entries(d, p, ipp, vp, old, new, resume=False, stats=NO_STATS,
+                  allocated=None, ip_ranges=None):
+    """Allocate the IPs and VLANs of the given entries
+
+    :param d: the content of the input file as dict
+    :param p: the result of a previous allocation as dict
+    :param ipp: the IP pools, by subnet name
+    :param vp: the VLAN pools, by name
+    :param old: the entries allocated before, as returned by filter_entries()
+    :param new: the new entries, as returned by filter_entries()
+    :param resume: reuse the previous allocation of the old entries
+    :param stats: a Stats object to collect the timing statistics in
+    :param allocated: the Allocation of the entries allocated before (e.g.
+        by a previous call), by (node, entry name); the IP ranges can be
+        allocated from them and the new allocations are added to it
+    :param ip_ranges: the IpRangeAllocators of a previous call, updated
+        with the new IP ranges
+    :return: the Allocation of each entry, by (node, entry name), and the
+        IpRangeAllocator of each parent entry of an IP range
+    """
+    tmp = allocated if allocated is not None else {}
+    # keep track of the IP ranges per subnet
+    ipr = ip_ranges if ip_ranges is not None else {}
+
+    def range_allocator(parent_k):
+        """Get the IpRangeAllocator for the subnet of the given entry"""
+        if parent_k not in ipr:
+            ipr[parent_k] = new_range_allocator(tmp[parent_k])
+        return ipr[parent_k]
+
+    def run_for(input_, phase):
+        with stats.phase(phase):
+            deferred = alloc_subnets(input_)
+        with stats.phase(phase + '_ranges'):
+            alloc_ranges(deferred)
+
+    def alloc_subnets(input_):
+        """Allocate the subnets of the given entries and return the
+        (deferred) IP range entries"""
 
         deferred = OrderedDict()
 
-        for k, s in input_.items():
-            v = d['ipam'][k[0]]
+        # the subnets to be allocated, grouped per IP pool
+        # so that each pool can allocate all its subnets in one go
+        requests = OrderedDict()
+        vids = {}
 
+        for k, s in input_.items():
             # if 'size' is specified, a new range should be allocated
             # from a subnet created before so we defer this allocation
             # until after all normal subnets are allocated
-            if 'size' in s:
-                # find the key to the parent subnet
+            if s.parent is not None:
+                # the key to the parent subnet
                 # from where the range is supposed to be allocated from
-                parent_str = v['ip_range'][s['label']]
-                parent = parent_str.split('.')
-                assert len(parent) == 2,\
-                    "'{}' does not have the expected format (<node>.<entry> " \
-                    "or .<entry>)".format(parent_str)
-                deferred[k] = (s, parent[0], parent[1])
+                deferred[k] = (s,) + s.parent
                 continue
 
-            subnet_name = v['subnet'][s['label']]
-            ip_pool = ipp[subnet_name]
-
-            vlan_pool_name = v.get('vlan_pool', {}).get(s['label'])
-            vlan_pool = vp.get(vlan_pool_name)
+            ip_pool = ipp[s.subnet]
+            vlan_pool = vp.get(s.vlan_pool)
 
             # allocate a vlan is there is a vlan pool defined for the label
-            vid = vlan_pool.alloc() if vlan_pool is not None else None
+            if vlan_pool is not None and not vlan_pool.free_size:
+                raise SubnettingError(
+                    "No free VLAN left in the VLAN pool {0}"
+                    .format(s.vlan_pool))
+            vids[k] = vlan_pool.alloc() if vlan_pool is not None else None
 
             # allocate a new subnet if prefixlen is specified
-            if 'prefixlen' in s:
-                kind = 'subnet'
+            if 'prefixlen' not in s:
+                raise NotImplementedError
 
-                net = ip_pool.allocate_subnet(s['prefixlen'])
+            requests.setdefault(ip_pool, []).append((k, s['prefixlen']))
 
+        nets = {}
+        for ip_pool, reqs in requests.items():
+            allocated = ip_pool.allocate_blocks([x[1] for x in reqs])
+            nets.update((x[0], (ip_pool, first))
+                        for x, first in zip(reqs, allocated))
+
+        for k, s in input_.items():
+            if k in deferred:
+                continue
+
+            ip_pool, first = nets[k]
+            size = 1 << (ip_pool.width - s['prefixlen'])
+
+            if size >= 4:
                 # skip the first and the last IP  (network and broadcast)
+                # and reserve the last usable IP for the gateway
                 # if there are at least 4 usable IPs in the subnet
-                eidx = -2 if net.size >= 4 else -1
-                sidx = 1 if net.size >= 4 else 0
-                ip_range = netaddr.IPRange(net[sidx], net[eidx])
-
+                range_first, range_last = first + 1, first + size - 2
+                gw_offset = size - 2
             else:
-                raise NotImplementedError
+                range_first, range_last = first, first + size - 1
+                gw_offset = None
 
-            # reserve the last usable IP for the gateway
-            # if the net is big enough for that
-            gw_ip = net[-2] if net.size >= 4 else None
-
-            s['metadata'].update({'type': kind, 'label': s['label']})
-
-            tmp[k] = {
-                'vlan': vid,
-                'ip_range': ip_range,
-                'gateway': gw_ip,
-                'cidr': net,
-                'prefixlen': net.prefixlen,
-                'netmask': net.netmask,
-                'properties': s.get('properties', {}),
-                'metadata': s['metadata'],
-            }
+            s['metadata'].update(entry_metadata(s))
 
-        # handled deferred allocations
-        for k, v in deferred.items():
-            s, node_k, entry_k = v
+            tmp[k] = Allocation(ip_pool.version, first, s['prefixlen'],
+                                range_first, range_last, gw_offset, vids[k],
+                                s.get('properties', {}), s['metadata'])
 
-            # use the current node if there is no key for the parent node
-            node_k = v[1] or k[0]
+        return deferred
 
-            net = tmp[(node_k, entry_k)]['cidr']
+    def alloc_ranges(deferred):
+        """Allocate the deferred IP range entries"""
+        for k, v in deferred.items():
+            s, node_k, entry_k = v
 
-            # make sure the last IP is not used
-            # so that it can be used for the gateway
-            # start the ip range from -3 as -2 is the last usable ip
-            eidx = -3 if net.size >= 4 else -2
-            ip_range = ipr.setdefault(
-                (node_k, entry_k), IpRangeAllocator(net, end_index=eidx))
+            parent = tmp[(node_k, entry_k)]
+            ip_range = range_allocator((node_k, entry_k))
 
             # the sign of the size parameter is used to indicate
             # if the alloc should be done from the back
@@ -214,109 +878,509 @@ def alloc_ips(d, p):
                 size = s['size']
                 from_the_back = False
 
-            ip_range = ip_range.alloc(size, from_the_back)
-
-            # reserve the last usable IP for the gateway
-            # if the net is big enough for that
-            gw_ip = net[-2] if net.size >= 4 else None
-
-            s['metadata'].update({'type': 'ip_range',
-                                  'parent': (node_k, entry_k),
-                                  'label': s['label']})
-
-            tmp[k] = {
-                'vlan': None,
-                'ip_range': ip_range,
-                'gateway': gw_ip,
-                'cidr': net,
-                'prefixlen': net.prefixlen,
-                'netmask': net.netmask,
-                'properties': s.get('properties', {}),
-                'metadata': s['metadata'],
-            }
+            range_first, range_last = ip_range.alloc_interval(
+                size, from_the_back)
+
+            s['metadata'].update(entry_metadata(s, (node_k, entry_k)))
+
+            # the gateway is the one of the parent subnet
+            tmp[k] = Allocation(parent.version, parent.network,
+                                parent.prefixlen, range_first, range_last,
+                                parent.gateway_offset, None,
+                                s.get('properties', {}), s['metadata'])
+
+    def restore(input_, phase):
+        with stats.phase(phase):
+            deferred = restore_subnets(input_)
+        with stats.phase(phase + '_ranges'):
+            restore_ranges(input_, deferred)
+
+    def restore_subnets(input_):
+        """Reuse the previous allocation for the given (old) entries,
+        after making sure it matches the input and the restored pools.
+        Return the (deferred) IP range entries"""
+
+        deferred = []
+
+        for k, s in input_.items():
+            pv = p['ipam'][k[0]]['ipa'][k[1]]
+
+            # the ranges are restored after their parent subnets
+            if s.parent is not None:
+                deferred.append(k)
+                continue
+
+            ip_pool = ipp[s.subnet]
+            vlan_pool = vp.get(s.vlan_pool)
+            assert pv.prefixlen == s['prefixlen'] and \
+                ip_pool.is_reserved(pv.version, pv.network, pv.last()), \
+                "The previous allocation of {}.{} ({}) does not match " \
+                "the input or the subnet pool".format(k[0], k[1],
+                                                      pv.cidr_str())
 
-    old, new = filter_entries(d, p)
+            assert (pv['vlan'] is None) == (vlan_pool is None) and \
+                (vlan_pool is None or vlan_pool.is_allocated(pv['vlan'])), \
+                "The previous VLAN of {}.{} ({}) does not match " \
+                "the input or the VLAN pool".format(k[0], k[1], pv['vlan'])
+
+            s['metadata'].update(entry_metadata(s))
+
+            tmp[k] = Allocation(pv.version, pv.network, pv.prefixlen,
+                                pv.range_first, pv.range_last,
+                                pv.gateway_offset, pv.vlan,
+                                s.get('properties', {}), s['metadata'])
+
+        return deferred
+
+    def restore_ranges(input_, deferred):
+        """Reuse the previous allocation for the given IP range entries"""
+        for k in deferred:
+            s = input_[k]
+            pv = p['ipam'][k[0]]['ipa'][k[1]]
+            parent_k = s.parent
+            parent = tmp[parent_k]
+
+            assert pv.same_subnet(parent) and \
+                pv.range_last - pv.range_first + 1 == abs(s['size']), \
+                "The previous allocation of {}.{} ({}) does not match " \
+                "the input".format(k[0], k[1], pv.ip_range_str())
+
+            range_allocator(parent_k).reserve_interval(pv.range_first,
+                                                       pv.range_last)
+
+            s['metadata'].update(entry_metadata(s, parent_k))
+
+            tmp[k] = Allocation(pv.version, pv.network, pv.prefixlen,
+                                pv.range_first, pv.range_last,
+                                pv.gateway_offset, None,
+                                s.get('properties', {}), s['metadata'])
 
     # process the new entries last to avoid new entries
     # taking over IPs for old entries
-    run_for(old)
-    run_for(new)
+    if resume:
+        restore(old, 'restore_old')
+    else:
+        run_for(old, 'alloc_old')
+    run_for(new, 'alloc_new')
 
-    # create the final data structure
-    res = OrderedDict()
+    return tmp, ipr
 
-    for k, v in d['ipam'].items():
-        res[k] = {'properties': v.get('properties', {}), 'ipa': OrderedDict()}
-        for s in v['schema']:
-            res[k]['ipa'][s['name']] = tmp[(k, s['name'])]
 
-    r = {
-        'ipam': res,
-        'ip_pool': ipp,
-        'vlan_pool': vp,
-    }
-    # pass along any global properties
-    if d.get('properties'):
-        r['properties'] = d['properties']
-    return r
+def partition_entries(d, old, new):
+    """Split the entries into groups that can be allocated independently
+
+    The 'from' subnets are allocated by convert_subnets(), before the
+    entries, so an IP pool (or a VLAN pool) only changes when the entries
+    using it are allocated. Two entries are in the same group if they use
+    the same IP or VLAN pool, directly or through other entries, or if one
+    is an IP range of the other.
+
+    :param d: the content of the input file as dict
+    :param old: the old entries, as returned by filter_entries()
+    :param new: the new entries, as returned by filter_entries()
+    :return: a list of (old, new) tuples, one per group, with the entries
+        of the group in the same order as in old and new
+    """
+    return [(OrderedDict((k, old[k]) for k in old_g),
+             OrderedDict((k, new[k]) for k in new_g))
+            for old_g, new_g in partition_keys(old, new)]
+
+
+def partition_keys(old, new):
+    """Same as partition_entries() but return the keys of the entries of
+    each group, as lists"""
+    parents = {}
+
+    def find(x):
+        while parents.setdefault(x, x) != x:
+            # path halving
+            parents[x] = parents[parents[x]]
+            x = parents[x]
+        return x
+
+    def union(x, y):
+        parents[find(x)] = find(y)
+
+    # only the pools are joined, an entry is in the group of its IP pool
+    for entries in (old, new):
+        for s in entries.values():
+            if s.parent is None and s.vlan_pool is not None:
+                union(('subnet', s.subnet), ('vlan', s.vlan_pool))
+
+    # the group of each IP pool
+    roots = {}
+
+    def group_of(k, s):
+        # an IP range is in the group of its parent entry
+        seen = set()
+        while s.parent is not None and s.parent not in seen:
+            seen.add(s.parent)
+            k = s.parent
+            s = old.get(k) or new.get(k)
+            if s is None:
+                # the allocation fails without the parent entry
+                return find(('entry', k))
+        if s.parent is not None:
+            return find(('entry', k))
+        if s.subnet not in roots:
+            roots[s.subnet] = find(('subnet', s.subnet))
+        return roots[s.subnet]
+
+    groups = OrderedDict()
+    for i, entries in enumerate((old, new)):
+        for k, s in entries.items():
+            root = group_of(k, s)
+            if root not in groups:
+                groups[root] = ([], [])
+            groups[root][i].append(k)
+    return list(groups.values())
+
+
+def alloc_entries_parallel(d, p, ipp, vp, old, new, resume, jobs,
+                           stats=NO_STATS):
+    """Same as alloc_entries() but allocate the independent groups of
+    entries (see partition_entries()) in a pool of processes
+
+    The result is the same as the one of alloc_entries(); the pools used by
+    the entries are replaced in ipp and vp with the ones updated by the
+    processes.
+
+    The wall time of the parallel allocation is the 'alloc_parallel' phase
+    of stats and the phases of the processes are added up in
+    'alloc_parallel/<phase>' (see Stats.add_phases()).
+    """
+    groups = partition_entries(d, old, new)
+    if len(groups) < 2:
+        return alloc_entries(d, p, ipp, vp, old, new, resume, stats)
+
+    with stats.phase('alloc_parallel'):
+        # the input is passed to the processes when they are started (i.e.
+        # inherited, where processes are forked) and each task is only the
+        # index of a group
+        pool = multiprocessing.Pool(
+            min(jobs, len(groups)), initializer=_init_parallel,
+            initargs=((d, p, ipp, vp, groups, resume),))
+        try:
+            results = pool.map(_alloc_group, range(len(groups)), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    tmp = {}
+    ipr = {}
+    for (old_g, new_g), (entries, ipr_g, ipp_g, vp_g, phases) in \
+            zip(groups, results):
+        stats.add_phases(phases, 'alloc_parallel/')
+        for k, fields in entries:
+            s = old_g[k] if k in old_g else new_g[k]
+            tmp[k] = entry_allocation(s, fields)
+        ipr.update(ipr_g)
+        ipp.update(ipp_g)
+        vp.update(vp_g)
+    return tmp, ipr
+
+
+_parallel = None
+
+
+def _init_parallel(job):
+    global _parallel
+    _parallel = job
+
+
+def _alloc_group(i):
+    """Allocate the group of entries with the given index (run in a
+    process of the pool created by alloc_entries_parallel())"""
+    d, p, ipp, vp, groups, resume = _parallel
+    old, new = groups[i]
+    st = Stats()
+    tmp, ipr = alloc_entries(d, p, ipp, vp, old, new, resume, st)
+
+    # only send back the pools used by the group and the fields of
+    # the allocations (the properties and the metadata are set from the
+    # input)
+    ipp_g, vp_g = group_pools(list(old.values()) + list(new.values()), ipp,
+                              vp)
+    entries = [(k, allocation_fields(a)) for k, a in tmp.items()]
+    return entries, ipr, ipp_g, vp_g, st.phases
+
+
+def group_pools(entries, ipp, vp):
+    """The IP pools and the VLAN pools used by the given entries, by name"""
+    ipp_g = {}
+    vp_g = {}
+    for s in entries:
+        if s.parent is not None:
+            continue
+        ipp_g[s.subnet] = ipp[s.subnet]
+        if s.vlan_pool in vp:
+            vp_g[s.vlan_pool] = vp[s.vlan_pool]
+    return ipp_g, vp_g
+
+
+def allocation_fields(a):
+    """The fields of an Allocation, without its properties and metadata
+    (which are set from the input, see entry_allocation())"""
+    return (a.version, a.network, a.prefixlen, a.range_first, a.range_last,
+            a.gateway_offset, a.vlan)
+
+
+def entry_allocation(s, fields):
+    """Create the Allocation of an entry from the fields returned by
+    allocation_fields()"""
+    # the metadata is set the same way as in alloc_entries()
+    # (the dicts sent back by the processes may have another order)
+    s.metadata.update(entry_metadata(s, s.parent))
+    return Allocation(*fields, properties=s.schema.get('properties', {}),
+                      metadata=s.metadata)
+
+
+# the version of the content of the cache, part of the group hashes
+CACHE_VERSION = 1
+
+
+def group_hash(old, new, old_keys, new_keys, ipp, vp, p, resume):
+    """The content hash of the input of the group of entries with the given
+    keys
+
+    The allocation of a group only depends on its entries (in allocation
+    order), the state of its pools before the allocation and, with resume,
+    the previous allocation of its old entries. The IP pools are hashed
+    after convert_subnets(), so the hash changes when a subnet the pools
+    are derived from ('from') changes. The ids, the labels and the
+    properties of the entries are not part of the hash as they are set
+    from the input (see entry_allocation()).
+    """
+    entries = []
+    for i, (group, keys) in enumerate(((old, old_keys), (new, new_keys))):
+        for k in keys:
+            s = group[k]
+            entry = (k[0], k[1], i, s.schema.get('prefixlen'),
+                     s.schema.get('size'), s.subnet, s.vlan_pool, s.parent)
+            if resume and i == 0:
+                entry += allocation_fields(p['ipam'][k[0]]['ipa'][k[1]])
+            entries.append(entry)
+    ipp_g, vp_g = group_pools([old[k] for k in old_keys] +
+                              [new[k] for k in new_keys], ipp, vp)
+    pools = [[k, ipp_g[k].input[0], [str(x) for x in ipp_g[k].iter_cidrs()]]
+             for k in sorted(ipp_g)]
+    pools.extend([k, vp_g[k].first, vp_g[k].last, vp_g[k].unused()]
+                 for k in sorted(vp_g))
+    # without sort_keys, as it disables the C encoder of python 2
+    content = json.dumps([CACHE_VERSION, resume, entries, pools], default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def alloc_entries_cached(d, p, ipp, vp, old, new, resume, cache,
+                         stats=NO_STATS, jobs=1):
+    """Same as alloc_entries() but reuse the allocation of the groups of
+    entries (see partition_entries()) found in the cache
+
+    The groups are the parts of the dependency graph of the entries (the
+    entries, their IP ranges and the IP and VLAN pools they use) which are
+    allocated independently. A group is reused if the content hash of its
+    input (see group_hash()) is found in the cache; the other groups are
+    allocated, then the cache is replaced with the groups of this run.
+
+    :param cache: dict with the content of the cache file (see
+        load_cache()), updated in place
+    :return: the same as alloc_entries()
+    """
+    with stats.phase('hash_groups'):
+        groups = [(keys, group_hash(old, new, keys[0], keys[1], ipp, vp, p,
+                                    resume))
+                  for keys in partition_keys(old, new)]
+
+    tmp = {}
+    ipr = {}
+    cached = cache.get('groups', {})
+    with stats.phase('restore_cached'):
+        changed = set()
+        for (old_keys, new_keys), h in groups:
+            c = cached.get(h)
+            if c is None:
+                changed.update(old_keys)
+                changed.update(new_keys)
+                continue
+            for x in c['entries']:
+                k = (x[0], x[1])
+                s = old[k] if k in old else new[k]
+                tmp[k] = entry_allocation(s, x[2:])
+            # the IP ranges are reserved once all the subnets are restored
+            for k in old_keys + new_keys:
+                s = old[k] if k in old else new[k]
+                if s.parent is not None:
+                    if s.parent not in ipr:
+                        ipr[s.parent] = new_range_allocator(tmp[s.parent])
+                    ipr[s.parent].reserve_interval(tmp[k].range_first,
+                                                   tmp[k].range_last)
+            for k, v in c['ip_pool'].items():
+                ipp[k] = dict_to_ip_pool(v)
+            for k, v in c['vlan_pool'].items():
+                vp[k] = dict_to_vlan_pool(v)
+
+    old_c = OrderedDict((k, s) for k, s in old.items() if k in changed)
+    new_c = OrderedDict((k, s) for k, s in new.items() if k in changed)
+    if jobs > 1:
+        tmp_c, ipr_c = alloc_entries_parallel(d, p, ipp, vp, old_c, new_c,
+                                              resume, jobs, stats)
+    else:
+        tmp_c, ipr_c = alloc_entries(d, p, ipp, vp, old_c, new_c, resume,
+                                     stats)
+    tmp.update(tmp_c)
+    ipr.update(ipr_c)
+
+    with stats.phase('update_cache'):
+        groups_c = {}
+        for (old_keys, new_keys), h in groups:
+            if h in cached:
+                groups_c[h] = cached[h]
+                continue
+            ipp_g, vp_g = group_pools([old[k] for k in old_keys] +
+                                      [new[k] for k in new_keys], ipp, vp)
+            groups_c[h] = {
+                'entries': [[k[0], k[1]] + list(allocation_fields(tmp[k]))
+                            for k in old_keys + new_keys],
+                'ip_pool': dict((k, ip_pool_to_dict(v))
+                                for k, v in ipp_g.items()),
+                'vlan_pool': dict((k, vlan_pool_to_dict(v))
+                                  for k, v in vp_g.items()),
+            }
+        cache['version'] = CACHE_VERSION
+        cache['groups'] = groups_c
+
+    return tmp, ipr
+
+
+def load_cache(path):
+    """Load the cache saved by a previous run (see alloc_entries_cached()),
+    or return an empty one if the file does not exist or was saved by
+    another version of ipa"""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        cache = json.load(f)
+    if cache.get('version') != CACHE_VERSION:
+        return {}
+    return cache
+
+
+def save_cache(cache, path):
+    """Save the cache updated by alloc_ips()"""
+    with open(path + '.tmp', 'w') as f:
+        json.dump(cache, f)
+    # replace the file only when it is complete
+    os.rename(path + '.tmp', path)
+
+
+class _Entry(object):
+    """An ipam entry of a node: the schema entry, which is shared by all
+    the nodes using the schema and never modified, and the metadata of the
+    entry. Read like the schema entry, as a dict.
+
+    The labels of the entry are resolved by compile_schema(): subnet and
+    vlan_pool are the names of its pools, parent is the (node, entry name)
+    key to the parent entry of an IP range entry (None otherwise)."""
+
+    __slots__ = ('schema', 'metadata', 'subnet', 'vlan_pool', 'parent')
+
+    def __init__(self, schema, metadata, subnet=None, vlan_pool=None,
+                 parent=None):
+        self.schema = schema
+        self.metadata = metadata
+        self.subnet = subnet
+        self.vlan_pool = vlan_pool
+        self.parent = parent
+
+    def __getitem__(self, k):
+        if k == 'metadata':
+            return self.metadata
+        return self.schema[k]
+
+    def __contains__(self, k):
+        return k == 'metadata' or k in self.schema
+
+    def get(self, k, default=None):
+        return self[k] if k in self else default
 
 
 def filter_entries(d, p):
-    """Separate the new entries from the old/previously created ones"""
+    """Separate the new entries from the old/previously created ones
+
+    :return: two dicts of (node, entry name) -> _Entry: the old and the
+        new entries, in allocation order
+    """
     new = OrderedDict()
     old = OrderedDict()
+    previous = p.get('ipam', {})
+    # the labels of each schema: those of the subnets and of the ranges
+    labels = {}
+    # the compiled schemas, shared by the nodes using the same schema (yaml
+    # anchor) with the same pools for its labels
+    programs = {}
     for k, v in d['ipam'].items():
-        for s in v['schema']:
+        pipa = previous.get(k, {}).get('ipa', {})
+        schema_labels = labels.get(id(v['schema']))
+        if schema_labels is None:
+            schema_labels = labels[id(v['schema'])] = (
+                sorted(set(s['label'] for s in v['schema']
+                           if 'size' not in s)),
+                sorted(set(s['label'] for s in v['schema'] if 'size' in s)))
+        subnets = v.get('subnet', {})
+        vlan_pools = v.get('vlan_pool', {})
+        ip_ranges = v.get('ip_range', {})
+        key = (id(v['schema']),
+               tuple(subnets.get(x) for x in schema_labels[0]),
+               tuple(vlan_pools.get(x) for x in schema_labels[0]),
+               tuple(ip_ranges.get(x) for x in schema_labels[1]))
+        program = programs.get(key)
+        if program is None:
+            program = programs[key] = compile_schema(v)
+        for s, (subnet, vlan_pool, parent) in zip(v['schema'], program):
+            if parent is not None:
+                # use the current node if there is no key for the parent
+                # node
+                parent = (parent[0] or k, parent[1])
             # check if there is a previous allocation for the current entry
-            pv = p.get('ipam', {}).get(k, {}).get('ipa', {}).get(s['name'])
+            pv = pipa.get(s['name'])
             if pv is None:
                 # defer IP allocation for the new entries to the end
-                new[(k, s['name'])] = copy.deepcopy(s)
+                new[(k, s['name'])] = _Entry(
+                    s, dict(s.get('metadata', {})), subnet, vlan_pool, parent)
             else:
-                old[(k, s['name'])] = copy.deepcopy(s)
                 # propagate the metadata
-                old[(k, s['name'])]['metadata'] = pv['metadata']
+                old[(k, s['name'])] = _Entry(
+                    s, dict(pv['metadata']), subnet, vlan_pool, parent)
 
     # find the last used id then allocate ids for the new entries
-    last_id = max([x['metadata']['id'] for x in old.values()] or [0])
-    for k, v in new.items():
+    last_id = max([x.metadata['id'] for x in old.values()] or [0])
+    for v in new.values():
         # each entry gets an id in consecutive order of definition
         # the id is used to keep track of entries which are added later
         # (not included in the first version of the input file)
-        new[k] = copy.deepcopy(v)
-        new[k].setdefault('metadata', {})['id'] = last_id + 1
         last_id += 1
+        v.metadata['id'] = last_id
 
     # sort the old values based on the id
     # as allocation is done in the order inside the dict
     old = OrderedDict(
-        sorted(old.items(), key=lambda item: item[1]['metadata']['id']))
+        sorted(old.items(), key=lambda item: item[1].metadata['id']))
 
     return old, new
 
 
-def ip_range_to_dict(r):
-    """Convert an IPRange to a dict"""
-    return {
-        'start': str(r[0]),
-        'end': str(r[-1]),
-        'str': str(r),
-        'size': r.size,
-    }
-
-
 def ip_pool_to_dict(ipp):
     """Convert an IPPool object to a dict"""
     return {
         'input': ipp.input[0],
-        'unused': [str(x) for x in ipp.pool.iter_cidrs()],
+        'unused': [str(x) for x in ipp.iter_cidrs()],
     }
 
 
 def dict_to_ip_pool(d):
     """The reverse operation to ip_pool_to_dict()"""
     ipp = IPPool(d['input'])
-    ipp.pool = netaddr.IPSet(d['unused'])
+    ipp.set_unused(d['unused'])
     return ipp
 
 
@@ -331,18 +1395,15 @@ def vlan_pool_to_dict(vp):
 def dict_to_vlan_pool(d):
     """The reverse operation to vlan_pool_to_dict()"""
     vp = VlanPool(*d['input'])
-    vp.pool = iter(range(*d['unused']))
+    vp.set_unused(d['unused'])
     return vp
 
 
 def deobjectify(d):
     """Remove the objects from the return dict"""
     for entry in d['ipam'].values():
-        for v in entry['ipa'].values():
-            v['ip_range'] = ip_range_to_dict(v['ip_range'])
-            v['netmask'] = str(v['netmask'])
-            v['cidr'] = str(v['cidr'])
-            v['gateway'] = str(v['gateway']) if v['gateway'] else None
+        for k, v in entry['ipa'].items():
+            entry['ipa'][k] = v.to_dict()
 
     for k, v in d['ip_pool'].items():
         d['ip_pool'][k] = ip_pool_to_dict(v)
@@ -354,27 +1415,220 @@ def deobjectify(d):
 
 
 def objectify(d):
-    """Convert strings to netaddr objects where applicable
+    """Convert the entries to Allocation objects and the pools to pool
+    objects
     Note: this is the reverse operation of deobjectify()
     """
+    return objectify_pools(objectify_entries(d))
+
+
+def objectify_entries(d):
+    """Convert the entries to Allocation objects"""
     for entry in d['ipam'].values():
-        for v in entry['ipa'].values():
-            v['ip_range'] = netaddr.IPRange(v['ip_range']['start'],
-                                            v['ip_range']['end'])
-            v['netmask'] = netaddr.IPAddress(v['netmask'])
-            v['cidr'] = netaddr.IPNetwork(v['cidr'])
-            if v['gateway']:
-                v['gateway'] = netaddr.IPAddress(v['gateway'])
+        for k, v in entry['ipa'].items():
+            entry['ipa'][k] = Allocation.from_dict(v)
+
+    return d
 
+
+def objectify_pools(d):
+    """Convert the ip_pool and vlan_pool dicts to pool objects"""
     for k, v in d['ip_pool'].items():
-        d[k] = dict_to_ip_pool(v)
+        d['ip_pool'][k] = dict_to_ip_pool(v)
 
     for k, v in d['vlan_pool'].items():
-        d[k] = dict_to_vlan_pool(v)
+        d['vlan_pool'][k] = dict_to_vlan_pool(v)
 
     return d
 
 
+def pools_to_dicts(d):
+    """Return a copy of d with the ip_pool and vlan_pool sections converted
+    to dicts (the pools and the entries of d are not changed)"""
+    return dict(d,
+                ip_pool=dict((k, ip_pool_to_dict(v))
+                             for k, v in d['ip_pool'].items()),
+                vlan_pool=dict((k, vlan_pool_to_dict(v))
+                               for k, v in d['vlan_pool'].items()))
+
+
+def load_previous(path, stats=NO_STATS):
+    """Load the result of a previous allocation, in json or snapshot format
+
+    The entries of a snapshot are decoded lazily, when accessed.
+    """
+    if snapshot.is_snapshot(path):
+        with stats.phase('load_previous'):
+            d = snapshot.load(path)
+        with stats.phase('objectify'):
+            return objectify_pools(d)
+
+    with stats.phase('load_previous'):
+        with open(path) as f:
+            d = json.load(f)
+    with stats.phase('objectify'):
+        return objectify(d)
+
+
+def write_output(d, output_format, f, p=None, report=None):
+    """Write the response to f in the given output format
+
+    :param p: the previous allocation, with the pools as dicts (only used
+        by the diff output)
+    :param report: the report of the pools (only used by the report
+        output), created from d if not given (see pool_report())
+    """
+    if output_format == 'json':
+        write_json(d, f)
+    elif output_format == 'diff':
+        write_diff(d, p or {}, f)
+        return
+    elif output_format == 'report':
+        write_report(report or pool_report(d), f)
+    elif output_format == 'yaml-anchors':
+        f.write(to_yaml_anchors(d))
+    elif output_format == 'human':
+        write_human(d, f)
+    elif output_format == 'internal':
+        f.write(str(d))
+    elif output_format == 'snapshot':
+        # binary output, written as it is
+        snapshot.dump(pools_to_dicts(d), f)
+        return
+    f.write('\n')
+
+
+def write_json(d, f):
+    """Write the response to f in json format
+
+    The ipam entries are converted and written one at a time, so the
+    whole json string is never built in memory. The output is the same
+    as json.dumps(deobjectify(d), indent=2).
+    """
+    encoder = json.JSONEncoder(indent=2)
+
+    def write_value(v, level):
+        # nested values are indented relative to their level
+        f.write(encoder.encode(v).replace('\n', '\n' + '  ' * level))
+
+    def write_dict(items, level):
+        # items is an iterable of (key, function writing the value) tuples
+        empty = True
+        for k, write in items:
+            f.write(encoder.item_separator if not empty else '{')
+            f.write('\n' + '  ' * (level + 1))
+            f.write(encoder.encode(k) + encoder.key_separator)
+            write(level + 1)
+            empty = False
+        f.write('{}' if empty else '\n' + '  ' * level + '}')
+
+    def write_entries(ipa, level):
+        write_dict(((k, partial(write_value, v.to_dict()))
+                    for k, v in ipa.items()), level)
+
+    def write_node(node, level):
+        write_dict(((k, partial(write_entries if k == 'ipa' else write_value,
+                                v))
+                    for k, v in node.items()), level)
+
+    def write_top(k, v, level):
+        if k == 'ipam':
+            write_dict(((k1, partial(write_node, v1))
+                        for k1, v1 in v.items()), level)
+        elif k == 'ip_pool':
+            write_dict(((k1, partial(write_value, ip_pool_to_dict(v1)))
+                        for k1, v1 in v.items()), level)
+        elif k == 'vlan_pool':
+            write_dict(((k1, partial(write_value, vlan_pool_to_dict(v1)))
+                        for k1, v1 in v.items()), level)
+        else:
+            write_value(v, level)
+
+    write_dict(((k, partial(write_top, k, v)) for k, v in d.items()), 0)
+
+
+def write_diff(d, p, f):
+    """Write the changes since the previous allocation to f, as one json
+    object per line
+
+    The entries are compared by (node, entry name) and by the fields of
+    their allocation (the subnet, the IP range, the gateway and the VLAN,
+    see allocation_fields()), so a change of their properties or metadata
+    alone is not reported. They are written as
+    {"type": "entry", "change": "added"/"changed"/"freed", "node": ...,
+    "entry": ..., "value": ..., "previous": ...} with the entries in the
+    format of the json output (or null). Then the IP and VLAN pools which
+    changed are written as {"type": "ip_pool"/"vlan_pool", "change": ...,
+    "name": ..., "allocated": [...], "released": [...]} with the subnets
+    (or the [start, end) VLAN ranges) allocated and released since the
+    previous allocation.
+
+    :param d: the result of alloc_ips()
+    :param p: the previous allocation, with the pools as dicts
+    """
+    def write(*items):
+        f.write(json.dumps(OrderedDict(items)) + '\n')
+
+    def write_entry(change, node_k, k, v, pv):
+        write(('type', 'entry'), ('change', change), ('node', node_k),
+              ('entry', k), ('value', v.to_dict() if v is not None else None),
+              ('previous', pv.to_dict() if pv is not None else None))
+
+    previous = p.get('ipam', {})
+    for node_k, node in d['ipam'].items():
+        pipa = previous[node_k]['ipa'] if node_k in previous else {}
+        for k, v in node['ipa'].items():
+            pv = pipa.get(k)
+            if pv is None:
+                write_entry('added', node_k, k, v, None)
+            elif allocation_fields(pv) != allocation_fields(v):
+                write_entry('changed', node_k, k, v, pv)
+    for node_k in previous:
+        ipa_ = d['ipam'][node_k]['ipa'] if node_k in d['ipam'] else {}
+        # in the order of definition (the order of the entries of the json
+        # file is lost when it is loaded)
+        freed = sorted(((k, pv) for k, pv in previous[node_k]['ipa'].items()
+                        if k not in ipa_),
+                       key=lambda x: x[1].metadata['id'])
+        for k, pv in freed:
+            write_entry('freed', node_k, k, None, pv)
+
+    def write_pools(pool_type, pools, previous_pools, delta):
+        for k in sorted(set(pools) | set(previous_pools)):
+            if k not in pools:
+                write(('type', pool_type), ('change', 'freed'), ('name', k),
+                      ('allocated', []), ('released', []))
+                continue
+            allocated, released = delta(pools[k], previous_pools.get(k))
+            if allocated or released:
+                write(('type', pool_type),
+                      ('change', 'changed' if k in previous_pools
+                       else 'added'),
+                      ('name', k), ('allocated', allocated),
+                      ('released', released))
+
+    def ip_pool_delta(ipp, prev):
+        unused = netaddr.IPSet(ipp.iter_cidrs())
+        if prev is None:
+            # a new pool: all the subnets allocated from it
+            prev_unused = netaddr.IPSet(IPPool(*ipp.input).iter_cidrs())
+        elif prev['unused'] == [str(x) for x in ipp.iter_cidrs()]:
+            return [], []
+        else:
+            prev_unused = netaddr.IPSet(prev['unused'])
+        return ([str(x) for x in (prev_unused - unused).iter_cidrs()],
+                [str(x) for x in (unused - prev_unused).iter_cidrs()])
+
+    def vlan_pool_delta(vp, prev):
+        prev_used = dict_to_vlan_pool(prev)._used if prev is not None else 0
+        return (bits_to_ranges(vp._used & ~prev_used, vp.first),
+                bits_to_ranges(prev_used & ~vp._used, vp.first))
+
+    write_pools('ip_pool', d['ip_pool'], p.get('ip_pool', {}), ip_pool_delta)
+    write_pools('vlan_pool', d['vlan_pool'], p.get('vlan_pool', {}),
+                vlan_pool_delta)
+
+
 def to_yaml_anchors(d):
     """Convert the response to an yaml anchor string that can be used in
     other yaml files, e.g. in j2i templates"""
@@ -397,75 +1651,187 @@ def to_yaml_anchors(d):
     return "\n".join(['ipam:'] + sorted(res))
 
 
-def to_human(d):
-    """Convert the response to a human readable format"""
-    deobjectify(d)
+def requested_prefixlens(d):
+    """The prefixlens of the subnets requested from each IP pool by the
+    input (by the entries and the 'from' subnets)
+
+    :param d: the content of the input file as dict
+    :return: dict of subnet name -> sorted list of prefixlens
+    """
+    res = {}
+    for v in d.get('subnet', {}).values():
+        if 'from' in v and 'prefixlen' in v:
+            res.setdefault(v['from'], set()).add(v['prefixlen'])
+    for v in d['ipam'].values():
+        subnets = v.get('subnet', {})
+        for s in v['schema']:
+            if 'prefixlen' in s and s['label'] in subnets:
+                res.setdefault(subnets[s['label']], set()).add(s['prefixlen'])
+    return dict((k, sorted(v)) for k, v in res.items())
+
+
+def pool_report(d, ip_ranges=None, requested=None):
+    """The utilization of the IP pools, IP ranges and VLAN pools of an
+    allocation
+
+    The report is built from the counters of the pools, which are kept up
+    to date by the allocations, so the free space is not scanned.
+
+    :param d: the result of alloc_ips()
+    :param ip_ranges: the IpRangeAllocator of each parent entry of an IP
+        range (see alloc_ips())
+    :param requested: the prefixlens to count the free subnets of, by IP
+        pool (see requested_prefixlens()); all the prefixlens from the
+        biggest free subnet by default
+    :return: OrderedDict with an ip_pool, ip_range and vlan_pool section,
+        each one an OrderedDict of name -> counters
+    """
+    requested = requested or {}
+
+    def counters(pool, largest_free):
+        return [('size', pool.size),
+                ('used', pool.used_size),
+                ('free', pool.free_size),
+                ('largest_free', largest_free),
+                ('free_fragments', pool.free_fragments)]
+
+    ip_pools = OrderedDict()
+    for k in sorted(d['ip_pool']):
+        v = d['ip_pool'][k]
+        ip_pools[k] = OrderedDict(
+            [('cidr', v.input[0])] +
+            counters(v, v.largest_free_prefixlen) +
+            [('fit', v.fit_counts(requested.get(k)))])
+
+    ranges = OrderedDict()
+    for k in sorted(ip_ranges or {}):
+        v = ip_ranges[k]
+        ranges['.'.join(k)] = OrderedDict(
+            [('cidr', str(v._net))] + counters(v, v.largest_free_size))
+
+    vlan_pools = OrderedDict()
+    for k in sorted(d['vlan_pool']):
+        v = d['vlan_pool'][k]
+        vlan_pools[k] = OrderedDict(
+            [('range', [v.first, v.last])] +
+            counters(v, v.largest_free_size))
+
+    return OrderedDict([('ip_pool', ip_pools), ('ip_range', ranges),
+                        ('vlan_pool', vlan_pools)])
+
+
+def write_report(report, f):
+    """Write a report returned by pool_report() to f, as one table per
+    section"""
+    def percent(v):
+        if not v['size']:
+            return '-'
+        return '{0:.1f}%'.format(100.0 * v['used'] / v['size'])
+
+    def largest(v):
+        if v['largest_free'] is None:
+            return '-'
+        return str(v['largest_free'])
+
+    ip_pools = [
+        (k, v['cidr'], str(v['size']), str(v['used']), str(v['free']),
+         percent(v),
+         '/{0}'.format(v['largest_free'])
+         if v['largest_free'] is not None else '-',
+         str(v['free_fragments']),
+         ' '.join('/{0}:{1}'.format(*x) for x in v['fit'].items()) or '-')
+        for k, v in report['ip_pool'].items()]
+    ip_ranges = [
+        (k, v['cidr'], str(v['size']), str(v['used']), str(v['free']),
+         percent(v), largest(v), str(v['free_fragments']))
+        for k, v in report['ip_range'].items()]
+    vlan_pools = [
+        (k, '{0}-{1}'.format(v['range'][0], v['range'][1] - 1),
+         str(v['size']), str(v['used']), str(v['free']), percent(v),
+         largest(v), str(v['free_fragments']))
+        for k, v in report['vlan_pool'].items()]
+
+    tables = [
+        (("IP_POOL", "CIDR", "SIZE", "USED", "FREE", "USED%", "LARGEST_FREE",
+          "FRAGMENTS", "FIT"), ip_pools),
+        (("IP_RANGE", "CIDR", "SIZE", "USED", "FREE", "USED%",
+          "LARGEST_FREE", "FRAGMENTS"), ip_ranges),
+        (("VLAN_POOL", "RANGE", "SIZE", "USED", "FREE", "USED%",
+          "LARGEST_FREE", "FRAGMENTS"), vlan_pools),
+    ]
+    blocks = []
+    for title, rows in tables:
+        if not rows:
+            continue
+        widths = [max(len(x) for x in column)
+                  for column in zip(title, *rows)]
+        lines = ["  ".join(c.ljust(w) for c, w in zip(row, widths)).rstrip()
+                 for row in [title] + rows]
+        lines.insert(1, "-" * (sum(widths) + 2 * (len(widths) - 1)))
+        blocks.append("\n".join(lines))
+    # the tables are separated by a blank line, write_output() ends the
+    # last one
+    f.write("\n\n".join(blocks))
+
+
+def human_columns(node_k, entry_k, v):
+    """The columns of an ipa entry in the human readable format"""
+    properties = v.properties
+    return (node_k,
+            # use the name inside properties, if specified
+            properties.get('name') or entry_k,
+            v.cidr_str(),
+            v.ip_range_str(),
+            v.gateway_str() or '-',
+            str(v.vlan or '-'),
+            properties.get('desc') or '-')
+
+
+def write_human(d, f):
+    """Write the response to f in a human readable format
+
+    The column widths are calculated in a single pass over the entries,
+    then the rows are written one by one.
+    """
     d = d['ipam']
 
-    r = []
-
-    # calculate the longest key names and use the info to align the output
-    l_nf = max(
-        [len(x) for x in d.keys()] +
-        [len("NF")]
-    )
-    l_net = max(
-        [len(x) for v in d for x in d[v]['ipa'].keys()] +
-        [len(x.get('properties', {}).get('name') or '-') for v in d for x in d[v]['ipa'].values()] +
-        [len("NET")]
-    )
-    l_ip = max(
-        [len(x['cidr']) for v in d for x in d[v]['ipa'].values()] +
-        [len("CIDR")]
-    )
-    l_vlan = max(
-        [len(str(x['vlan'])) for v in d for x in d[v]['ipa'].values()] +
-        [len("VLAN")]
-    )
-    l_ipr = max(
-        [len(x['ip_range']['str']) for v in d for x in d[v]['ipa'].values()] +
-        [len("IP_RANGE")]
-    )
-    l_gw = max(
-        [len(x['gateway'] or '-')for v in d for x in d[v]['ipa'].values()] +
-        [len("GW_IP")]
-    )
-    l_desc = max(
-        [len(x.get('properties', {}).get('desc') or '-')
-         for v in d for x in d[v]['ipa'].values()] +
-        [len("DESCRIPTION")]
-    )
-
-    def add_entry(c1, c2, c3, c4, c5, c6, c7):
-        template = "{}  {}  {}  {}  {}  {}  {}"
-        r.append(template.format(c1.ljust(l_nf),
-                                 c2.ljust(l_net),
-                                 c3.ljust(l_ip),
-                                 c4.ljust(l_ipr),
-                                 c5.ljust(l_gw),
-                                 c6.ljust(l_vlan),
-                                 c7.ljust(l_desc)))
+    # calculate the longest values of each column (title included)
+    # and use the info to align the output
+    widths = [len(x) for x in
+              ("NF", "NET", "CIDR", "IP_RANGE", "GW_IP", "VLAN",
+               "DESCRIPTION")]
+    for k, v in d.items():
+        for k1, v1 in v['ipa'].items():
+            columns = human_columns(k, k1, v1)
+            widths = [max(w, len(c)) for w, c in zip(widths, columns)]
+            # the entry key and the actual vlan are taken into account
+            # even if the name in properties or '-' are printed instead
+            widths[1] = max(widths[1], len(k1))
+            widths[5] = max(widths[5], len(str(v1['vlan'])))
+
+    def write_row(columns):
+        f.write("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+
     # add the title
-    add_entry("NF", "NET", "CIDR", "IP_RANGE", "GW_IP", "VLAN", "DESCRIPTION")
-    r.append("-" * (l_nf + l_net + l_ip + l_vlan + l_ipr + l_gw + l_desc + 10))
+    write_row(("NF", "NET", "CIDR", "IP_RANGE", "GW_IP", "VLAN",
+               "DESCRIPTION"))
+    f.write("\n" + "-" * (sum(widths) + 10))
 
     for k, v in d.items():
         for k1, v1 in v['ipa'].items():
-            # use the name inside properties, if specified
-            name = v1.get('properties', {}).get('name') or k1
             # do not print the reserved IPs
             if v1.get('properties', {}).get('reserved', False):
                 continue
-            add_entry(k,
-                      name,
-                      v1['cidr'],
-                      v1['ip_range']['str'],
-                      v1['gateway'] or '-',
-                      str(v1['vlan'] or '-'),
-                      v1.get('properties', {}).get('desc') or '-')
+            f.write("\n")
+            write_row(human_columns(k, k1, v1))
+
 
-    return "\n".join(r)
+def to_human(d):
+    """Convert the response to a human readable format"""
+    f = StringIO()
+    write_human(d, f)
+    return f.getvalue()
 
 
 if __name__ == "__main__":
-    print(main(sys.argv[1:]))
+    main(sys.argv[1:], sys.stdout)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+"""Find the entries of an allocation by IP address, subnet or VLAN
+
+The index keeps the subnets of the subnet entries and the IP ranges of the
+IP range entries as two lists of intervals sorted by address. The subnets
+of an allocation never overlap, and neither do its IP ranges, so the
+entries containing an IP, inside a subnet or overlapping it are found with
+a binary search (and a scan of the matching entries).
+"""
+
+from collections import OrderedDict
+import argparse
+import bisect
+import json
+import sys
+
+import netaddr
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from allocation import ip_from_str
+import ipa
+import snapshot
+
+# the IPv6 addresses are indexed after all the IPv4 addresses
+_IPV6 = 1 << 128
+
+
+def _key(version, ip):
+    return ip | _IPV6 if version == 6 else ip
+
+
+def parse_query(s):
+    """Convert an IP, a CIDR or an IP range ('first-last') to
+    (first, last) index keys"""
+    if '-' in s:
+        first, last = s.split('-')
+        version, first = ip_from_str(first.strip())
+        _, last = ip_from_str(last.strip())
+    elif '/' in s:
+        net = netaddr.IPNetwork(s)
+        version, first, last = net.version, net.first, net.last
+    else:
+        version, first = ip_from_str(s)
+        last = first
+    return _key(version, first), _key(version, last)
+
+
+class _Intervals(object):
+    """Disjoint intervals sorted by address, with the entry of each one"""
+
+    def __init__(self, intervals):
+        intervals.sort(key=lambda x: x[0])
+        self.firsts = [x[0] for x in intervals]
+        self.lasts = [x[1] for x in intervals]
+        self.entries = [x[2] for x in intervals]
+        for i in range(1, len(intervals)):
+            assert self.firsts[i] > self.lasts[i - 1], \
+                "{0[0]}.{0[1]} is overlapping with {1[0]}.{1[1]}".format(
+                    self.entries[i][:2], self.entries[i - 1][:2])
+
+    def overlapping(self, first, last):
+        # the first interval ending at or after first
+        i = bisect.bisect_left(self.lasts, first)
+        res = []
+        while i < len(self.firsts) and self.firsts[i] <= last:
+            res.append(i)
+            i += 1
+        return res
+
+    def inside(self, first, last):
+        return [i for i in self.overlapping(first, last)
+                if first <= self.firsts[i] and self.lasts[i] <= last]
+
+
+class Index(object):
+    """An index of the entries of an allocation, by address and by VLAN
+
+    The queries return lists of (node, entry name, Allocation), sorted by
+    address, with the subnet entries before the IP range entries of the
+    same subnet.
+    """
+
+    def __init__(self, ipam=None, path=None):
+        """
+        :param ipam: the ipam section of an allocation (as returned by
+            alloc_ips() or load_previous())
+        :param path: the result of a previous allocation, in json or
+            snapshot format, loaded when the index is first queried
+            (instead of ipam)
+        """
+        self._ipam = ipam
+        self._path = path
+        self._subnets = None
+
+    def _build(self):
+        if self._subnets is not None:
+            return
+        if self._ipam is None:
+            self._ipam = load_ipam(self._path)
+
+        subnets = []
+        ranges = []
+        self._vlans = {}
+        for node_k, node in self._ipam.items():
+            for k, v in node['ipa'].items():
+                entry = (node_k, k, v)
+                if v.metadata.get('type') == 'ip_range':
+                    ranges.append((_key(v.version, v.range_first),
+                                   _key(v.version, v.range_last), entry))
+                else:
+                    subnets.append((_key(v.version, v.network),
+                                    _key(v.version, v.last()), entry))
+                if v.vlan is not None:
+                    self._vlans.setdefault(v.vlan, []).append(entry)
+        self._subnets = _Intervals(subnets)
+        self._ranges = _Intervals(ranges)
+
+    def _find(self, s, inside):
+        """The entries overlapping (or inside) the IP, CIDR or IP range s"""
+        self._build()
+        first, last = parse_query(s)
+        res = []
+        for intervals in (self._subnets, self._ranges):
+            find = intervals.inside if inside else intervals.overlapping
+            res.extend((intervals.firsts[i], intervals is self._ranges,
+                        intervals.entries[i])
+                       for i in find(first, last))
+        res.sort(key=lambda x: x[:2])
+        return [x[2] for x in res]
+
+    def find_ip(self, ip):
+        """The subnet entry and the IP range entry (if any) containing the
+        given IP"""
+        return self._find(ip, False)
+
+    def find_inside(self, s):
+        """The entries whose subnet (or IP range, for the IP range
+        entries) is inside the given CIDR or IP range"""
+        return self._find(s, True)
+
+    def find_overlapping(self, s):
+        """The entries whose subnet (or IP range, for the IP range entries)
+        overlaps the given CIDR or IP range"""
+        return self._find(s, False)
+
+    def find_vlan(self, vlan):
+        """The entries with the given VLAN"""
+        self._build()
+        return list(self._vlans.get(vlan, []))
+
+
+def load_ipam(path):
+    """Load the ipam section of a previous allocation, in json or snapshot
+    format (the pools are not loaded)"""
+    if snapshot.is_snapshot(path):
+        return snapshot.load(path)['ipam']
+    with open(path) as f:
+        return ipa.objectify_entries({'ipam': json.load(f)['ipam']})['ipam']
+
+
+def main(input_args, out=None):
+    parser = argparse.ArgumentParser(
+        description='Find the entries of an allocation by IP address, '
+                    'subnet or VLAN')
+    parser.add_argument(dest="previous_alloc",
+                        metavar="FILE.json",
+                        help='the result of a previous run/allocation, '
+                             'in json or snapshot format')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--ip',
+                       help='find the entries containing the IP')
+    group.add_argument('--inside',
+                       metavar='CIDR',
+                       help='find the entries inside the CIDR (or the IP '
+                            'range first-last)')
+    group.add_argument('--overlap',
+                       metavar='CIDR',
+                       help='find the entries overlapping the CIDR (or the '
+                            'IP range first-last)')
+    group.add_argument('--vlan',
+                       type=int,
+                       help='find the entries with the VLAN')
+    parser.add_argument('-o',
+                        dest="output_format",
+                        default="human",
+                        choices=['human', 'json'],
+                        help='the format of the output. Default: human')
+    args = parser.parse_args(input_args)
+
+    index = Index(path=args.previous_alloc)
+    if args.ip:
+        entries = index.find_ip(args.ip)
+    elif args.inside:
+        entries = index.find_inside(args.inside)
+    elif args.overlap:
+        entries = index.find_overlapping(args.overlap)
+    else:
+        entries = index.find_vlan(args.vlan)
+
+    # the entries found, in the format of the result of an allocation
+    res = OrderedDict()
+    for node_k, k, v in entries:
+        res.setdefault(node_k, {'ipa': OrderedDict()})['ipa'][k] = v
+
+    f = out or StringIO()
+    ipa.write_output({'ipam': res}, args.output_format, f)
+    if out is None:
+        return f.getvalue()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:], sys.stdout)
@@ -1,10 +1,26 @@
 #!/usr/bin/env python
 
+from collections import OrderedDict
+import json
 import logging
 import unittest
 import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 
+import netaddr
+
+import allocation
+import bench
 import ipa
+import lookup
+import server
+import stats
+import store
+import subnet
 
 
 def get_path_to_resource_file(tc_name, file_name):
@@ -31,6 +47,22 @@ class _BaseTestCase(unittest.TestCase):
             diff = ''.join(diff)
             raise self.failureException("{0}\n{1}".format(msg or '', diff))
 
+    def tmp_path(self, file_name):
+        """The path of a file in a temporary directory, which is removed at
+        the end of the test"""
+        if getattr(self, '_tmp_dir', None) is None:
+            self._tmp_dir = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, self._tmp_dir)
+        return os.path.join(self._tmp_dir, file_name)
+
+    def write_input(self, **kwargs):
+        """Write an input generated by bench.generate_input(**kwargs) to the
+        input.yaml temporary file (see tmp_path()) and return its path"""
+        input_file = self.tmp_path('input.yaml')
+        with open(input_file, 'w') as f:
+            f.write(bench.generate_input(**kwargs))
+        return input_file
+
 
 class IpaTest(_BaseTestCase):
 
@@ -95,13 +127,319 @@ class IpaTest(_BaseTestCase):
     def test_first_run_with_ip_range_local_reverse_yaml_anchors_output(self):
         self.run_test('first_run_with_ip_range_local_reverse', 'yaml-anchors', True)
 
-    def run_test(self, tc_name, output_format, is_first_run):
+    def test_prev_run_no_change_resume_json_output(self):
+        self.run_test('with_previous_no_change', 'json', False, ['--resume'])
+
+    def test_prev_run_basic_change_resume_json_output(self):
+        self.run_test('with_previous_basic_change', 'json', False,
+                      ['--resume'])
+
+    def test_prev_run_basic_change_resume_text_output(self):
+        self.run_test('with_previous_basic_change', 'human', False,
+                      ['--resume'])
+
+    def test_prev_run_basic_change_diff_output(self):
+        self.run_test('with_previous_basic_change', 'diff', False)
+
+    def test_prev_run_basic_change_resume_diff_output(self):
+        self.run_test('with_previous_basic_change', 'diff', False,
+                      ['--resume'])
+
+    def test_diff_no_change_and_freed(self):
+        prev_file = self.tmp_path('previous.json')
+        input_file = self.write_input(nodes=5)
+        ipa.main([input_file, '--first-run', '-o', 'json',
+                  '--output', prev_file])
+        for args in [[], ['--resume']]:
+            self.assertEqual(ipa.main([input_file, '-p', prev_file,
+                                       '-o', 'diff'] + args), '')
+
+        self.write_input(nodes=4)
+        lines = [json.loads(x) for x in ipa.main(
+            [input_file, '-p', prev_file, '-o', 'diff']).splitlines()]
+        self.assertEqual(
+            [(x['change'], x['node'], x['entry']) for x in lines
+             if x['type'] == 'entry'],
+            [('freed', 'node_4', k) for k in
+             ['net_0', 'net_1', 'net_2', 'net6', 'local_range',
+              'shared_range']])
+        self.assertIsNone(lines[0]['value'])
+        # the subnets and VLANs of the freed entries are released
+        self.assertEqual(
+            lines[-1], {'type': 'vlan_pool', 'change': 'changed',
+                        'name': 'pool1', 'allocated': [],
+                        'released': [[9, 11]]})
+
+    def test_new_prev_run_no_change_resume_json_output(self):
+        self.run_test('with_new_previous_no_change', 'json', False,
+                      ['--resume'])
+
+    def test_first_run_json_output_file(self):
+        output_file = self.tmp_path('output.json')
+        ipa.main([get_path_to_resource_file('first_run', 'input.yaml'),
+                  '--first-run', '-o', 'json', '--output', output_file])
+        with open(output_file) as f:
+            res = f.read()
+        with open(get_path_to_resource_file('first_run', 'output.json')) as f:
+            self.assertEqualWithDiff(f.read(), res)
+
+    def test_stats(self):
+        st = stats.Stats()
+        res = ipa.main(
+            [get_path_to_resource_file('with_previous_basic_change',
+                                       'input.yaml'),
+             '-p', get_path_to_resource_file('with_previous_basic_change',
+                                             'previous.json'),
+             '-o', 'json'], stats=st)
+        with open(get_path_to_resource_file('with_previous_basic_change',
+                                            'output.json')) as f:
+            self.assertEqualWithDiff(f.read().strip(), res.strip())
+        self.assertEqual(
+            list(st.phases),
+            ['load_input', 'load_previous', 'objectify', 'convert_pools',
+             'filter_entries', 'alloc_old', 'alloc_old_ranges', 'alloc_new',
+             'alloc_new_ranges', 'build_result', 'output'])
+        self.assertEqual(st.ip_pools['main_net']['allocations'], 24)
+        self.assertEqual(st.ip_pools['main_net']['free_fragments'], 3)
+        self.assertEqual(st.vlan_pools['pool1']['allocations'], 11)
+        self.assertEqual(st.ip_ranges['shared_net.pool_net']['allocations'],
+                         9)
+        self.assertEqual(json.loads(st.to_json())['vlan_pools'],
+                         {'pool1': {'allocations': 11, 'free_fragments': 1,
+                                    'free_size': 889}})
+
+    def test_alloc_ips_does_not_modify_input(self):
+        tc_name = 'with_previous_basic_change'
+        with open(get_path_to_resource_file(tc_name, 'input.yaml')) as f:
+            d = ipa.load_input(f)
+        p = ipa.load_previous(get_path_to_resource_file(tc_name,
+                                                        'previous.json'))
+
+        def dump():
+            pools = ipa.pools_to_dicts(p)
+            return json.dumps(d), json.dumps(
+                [[v['metadata'] for v in x['ipa'].values()]
+                 for x in p['ipam'].values()]), json.dumps(
+                [pools['ip_pool'], pools['vlan_pool']], sort_keys=True)
+
+        before = dump()
+        for resume in [False, True]:
+            ipa.alloc_ips(d, p, resume)
+            self.assertEqual(before, dump())
+
+    def test_parallel_same_as_serial(self):
+        prev_file = self.tmp_path('previous.json')
+        input_file = self.write_input(nodes=40, sites=3)
+        ipa.main([input_file, '--first-run', '-o', 'json',
+                  '--output', prev_file])
+        self.write_input(nodes=50, sites=3)
+        for args in [['--first-run'], ['-p', prev_file],
+                     ['-p', prev_file, '--resume']]:
+            args = [input_file, '-o', 'json'] + args
+            self.assertEqualWithDiff(ipa.main(args),
+                                     ipa.main(args + ['-j', '3']))
+        # the phases of the processes are added up
+        st = stats.Stats()
+        ipa.main(args + ['-j', '3'], stats=st)
+        self.assertIn('alloc_parallel', st.phases)
+        self.assertIn('alloc_parallel/alloc_new', st.phases)
+        self.assertNotIn('alloc_new', st.phases)
+
+    def test_parallel_allocation_error(self):
+        d = ipa.load_input(bench.generate_input(nodes=6, sites=3))
+        d['ipam']['node_4'] = dict(
+            d['ipam']['node_4'],
+            schema=[{'name': 'big', 'prefixlen': 8, 'label': 'linknet'}])
+        # the error raised in a process is raised again by alloc_ips()
+        for jobs in [1, 3]:
+            self.assertRaises(subnet.SubnettingError, ipa.alloc_ips,
+                              d, {}, jobs=jobs)
+
+    def test_cache_same_as_full_allocation(self):
+        prev_file = self.tmp_path('previous.json')
+        cache_file = self.tmp_path('cache.json')
+        input_file = self.write_input(nodes=40, sites=3)
+        ipa.main([input_file, '--first-run', '-o', 'json',
+                  '--output', prev_file])
+        for nodes in [40, 50, 50, 45]:
+            self.write_input(nodes=nodes, sites=3)
+            for args in [['--first-run'], ['-p', prev_file],
+                         ['-p', prev_file, '--resume']]:
+                args = [input_file, '-o', 'json'] + args
+                self.assertEqualWithDiff(
+                    ipa.main(args),
+                    ipa.main(args + ['--cache', cache_file]))
+                self.assertEqualWithDiff(
+                    ipa.main(args),
+                    ipa.main(args + ['--cache', cache_file, '-j', '2']))
+
+    def test_cache_reuses_unchanged_groups(self):
+        d = ipa.load_input(bench.generate_input(nodes=6, sites=3))
+        cache = {}
+        ipa.alloc_ips(d, {}, cache=cache)
+        # per site: the shared subnet, the linknets, the vips and the IPv6
+        # subnets
+        self.assertEqual(len(cache['groups']), 12)
+        groups = dict(cache['groups'])
+
+        # only the groups of the site of the new node are allocated
+        d['ipam']['node_6'] = d['ipam']['node_0']
+        ipa.alloc_ips(d, {}, cache=cache)
+        self.assertEqual(len(set(groups) & set(cache['groups'])), 8)
+
+        # the cached allocation is the one used
+        k = [h for h, v in cache['groups'].items()
+             if v['entries'][0][:2] == ['node_1', 'net6']][0]
+        cache['groups'][k]['entries'][0][3] += 1 << 64
+        res = ipa.alloc_ips(d, {}, cache=cache)
+        self.assertEqual(str(res['ipam']['node_1']['ipa']['net6']['cidr']),
+                         '2001:db9:0:1::/64')
+
+    def test_partition_entries(self):
+        d = ipa.load_input(bench.generate_input(nodes=4, sites=2))
+        old, new = ipa.filter_entries(d, {})
+        groups = ipa.partition_entries(d, old, new)
+        # per site: the shared subnet and its ranges, the linknet subnets
+        # (same VLAN pool) and their ranges, the vip subnets and the IPv6
+        # subnets
+        self.assertEqual(len(groups), 8)
+        self.assertEqual(sum(len(x[1]) for x in groups), len(new))
+        self.assertEqual(
+            list(groups[0][1]),
+            [('shared_0', 'pool_net'), ('node_0', 'shared_range'),
+             ('node_2', 'shared_range')])
+        self.assertEqual(
+            list(groups[2][1]),
+            [('node_0', 'net_0'), ('node_0', 'net_1'),
+             ('node_0', 'local_range'), ('node_2', 'net_0'),
+             ('node_2', 'net_1'), ('node_2', 'local_range')])
+
+    def test_compiled_schemas(self):
+        d = ipa.load_input(bench.generate_input(nodes=4, sites=2))
+        _, new = ipa.filter_entries(d, {})
+        # the nodes of both sites share the schemas, not the pools
+        self.assertEqual(
+            [(new[(k, 'net_0')].subnet, new[(k, 'net_0')].vlan_pool)
+             for k in ('node_0', 'node_1')],
+            [('link_net_0', 'pool1_0'), ('link_net_1', 'pool1_1')])
+        self.assertEqual(new[('node_0', 'net_2')].vlan_pool, None)
+        self.assertEqual(new[('node_1', 'local_range')].parent,
+                         ('node_1', 'net_0'))
+        self.assertEqual(new[('node_1', 'shared_range')].parent,
+                         ('shared_1', 'pool_net'))
+
+        d['ipam']['node_1']['ip_range'] = {'local': 'net_0', 'shared': '.x'}
+        with self.assertRaises(AssertionError):
+            ipa.filter_entries(d, {})
+
+    def test_report(self):
+        input_file = get_path_to_resource_file('first_run', 'input.yaml')
+        with open(input_file) as f:
+            d = ipa.load_input(f)
+        ip_ranges = {}
+        report = ipa.pool_report(ipa.alloc_ips(d, {}, ip_ranges=ip_ranges),
+                                 ip_ranges, ipa.requested_prefixlens(d))
+        self.assertEqual(dict(report['ip_pool']['net1']),
+                         {'cidr': '10.10.0.0/16', 'size': 65536, 'used': 512,
+                          'free': 65024, 'largest_free': 17,
+                          'free_fragments': 1, 'fit': {24: 254}})
+        self.assertEqual(report['ip_range']['shared_net.pool_net']['used'],
+                         42)
+        self.assertEqual(dict(report['vlan_pool']['pool1']),
+                         {'range': [100, 1000], 'size': 900, 'used': 5,
+                          'free': 895, 'largest_free': 895,
+                          'free_fragments': 1})
+
+        res = ipa.main([input_file, '--first-run', '-o', 'report'])
+        # the tables are separated by a blank line
+        self.assertEqual([len(x.splitlines()) for x in res.split('\n\n')],
+                         [5, 3, 3])
+        output_file = self.tmp_path('report.txt')
+        ipa.main([input_file, '--first-run', '-o', 'report',
+                  '--output', output_file])
+        with open(output_file) as f:
+            self.assertEqual(f.read(), res + '\n')
+        self.assertEqual(res.splitlines()[3].split(),
+                         ['net1', '10.10.0.0/16', '65536', '512', '65024',
+                          '0.8%', '/17', '1', '/24:254'])
+
+    def test_preflight(self):
+        input_file = get_path_to_resource_file('first_run', 'input.yaml')
+        self.assertEqual(ipa.main([input_file, '--preflight']), '')
+
+        with open(input_file) as f:
+            d = ipa.load_input(f)
+        self.assertEqual(ipa.preflight(d), [])
+        d['subnet']['main_net']['prefixlen'] = 27
+        d['subnet']['shared_net']['prefixlen'] = 25
+        d['vlan_pool']['pool1']['end'] = 103
+        d['ipam']['shared_net']['schema'][1]['size'] = 250
+        d['ipam']['bar_2']['vlan_pool'] = {'vip': 'pool2'}
+        self.assertEqual(ipa.preflight(d), [
+            "Node bar_2: VLAN pool pool2 does not exist",
+            "IP pool main_net: 58 IPs requested (/28 x 2, /29 x 2, "
+            "/32 x 10), 32 available",
+            "IP pool shared_net: /24 requested from a /25",
+            "VLAN pool pool1: 5 VLANs requested, 3 available",
+            "IP range shared_net.pool_net: 272 IPs requested, 253 "
+            "available"])
+
+    def test_fast_yaml_loader(self):
+        for tc_name in ['first_run', 'first_run_with_ip_range_local']:
+            with open(get_path_to_resource_file(tc_name, 'input.yaml')) as f:
+                content = f.read()
+            self.assertEqual(
+                json.dumps(ipa.load_input(content)),
+                json.dumps(ipa.load_input(content, round_trip=True)))
+
+    def test_prev_run_basic_change_snapshot_json_output(self):
+        # convert the previous allocation to a snapshot then use it
+        prev_res = self.tmp_path('previous.snapshot')
+        prev_json = get_path_to_resource_file(
+            'with_previous_basic_change', 'previous.json')
+        with open(prev_res, 'wb') as f:
+            ipa.write_output(ipa.load_previous(prev_json), 'snapshot', f)
+        for extra_args in [[], ['--resume']]:
+            res = ipa.main([
+                get_path_to_resource_file('with_previous_basic_change',
+                                          'input.yaml'),
+                '-o', 'json', '-p', prev_res] + extra_args)
+            with open(get_path_to_resource_file(
+                    'with_previous_basic_change', 'output.json')) as f:
+                self.assertEqualWithDiff(f.read().strip(), res.strip())
+
+    def test_overlapping_subnets(self):
+        d = {'subnet': OrderedDict([
+            ('net1', {'cidr': '10.10.0.0/16'}),
+            ('net2', {'cidr': '2001:db8::/32'}),
+            ('net3', {'cidr': '10.11.0.0/16'}),
+            ('net4', {'cidr': '10.10.4.0/22'}),
+        ])}
+        with self.assertRaises(AssertionError) as cm:
+            ipa.convert_subnets(d)
+        self.assertEqual(
+            str(cm.exception),
+            "Subnet 10.10.4.0/22 is overlapping with previous subnet "
+            "10.10.0.0/16")
+
+        # the smaller subnet first in the input
+        d['subnet']['net1'] = d['subnet'].pop('net1')
+        with self.assertRaises(AssertionError) as cm:
+            ipa.convert_subnets(d)
+        self.assertEqual(
+            str(cm.exception),
+            "Subnet 10.10.0.0/16 is overlapping with previous subnet "
+            "10.10.4.0/22")
+
+    def run_test(self, tc_name, output_format, is_first_run, extra_args=()):
         if output_format == 'human':
             ofile_name = 'output.txt'
         elif output_format == 'json':
             ofile_name = 'output.json'
         elif output_format == 'yaml-anchors':
             ofile_name = 'output.yaml'
+        elif output_format == 'diff':
+            ofile_name = 'output.diff'
         else:
             raise NotImplementedError
 
@@ -118,6 +456,7 @@ class IpaTest(_BaseTestCase):
         else:
             prev_res = get_path_to_resource_file(tc_name, 'previous.json')
             args.extend(['-p', prev_res])
+        args.extend(extra_args)
 
         res = ipa.main(args)
 
@@ -128,7 +467,365 @@ class IpaTest(_BaseTestCase):
         self.assertEqualWithDiff(exp.strip(), res.strip())
 
 
+class IPPoolTest(_BaseTestCase):
+
+    def test_allocate_subnets_same_as_sequential(self):
+        prefixlens = [29, 28, 32, 24, 32, 30, 26, 32, 29]
+        batch = subnet.IPPool('10.10.0.0/22').allocate_subnets(prefixlens)
+        ipp = subnet.IPPool('10.10.0.0/22')
+        self.assertEqual(batch, [ipp.allocate_subnet(x) for x in prefixlens])
+
+    def test_allocate_subnets_exhausted(self):
+        ipp = subnet.IPPool('10.10.0.0/30')
+        self.assertRaises(subnet.SubnettingError,
+                          ipp.allocate_subnets, [31, 31, 32])
+        self.assertEqual(list(ipp.iter_cidrs()), [])
+
+    def test_reserved(self):
+        ipp = subnet.IPPool('10.10.0.0/24')
+        ipp.allocate_subnets([26, 30])
+        self.assertEqual(ipp.reserved,
+                         netaddr.IPSet(['10.10.0.0/26', '10.10.0.64/30']))
+        self.assertEqual(ipp.reserved | ipp.pool,
+                         netaddr.IPSet(['10.10.0.0/24']))
+
+    def test_allocate_blocks_ipv6(self):
+        ipp = subnet.IPPool('2001:db8::/32')
+        firsts = ipp.allocate_blocks([64, 48, 64, 56])
+        self.assertEqual(
+            [allocation.ip_to_str(x, 6) for x in firsts],
+            ['2001:db8::', '2001:db8:1::', '2001:db8:0:1::',
+             '2001:db8:0:100::'])
+        self.assertTrue(ipp.is_reserved(6, firsts[1], firsts[1] + 5))
+        self.assertEqual(ipp.free_size, (1 << 96) - (1 << 80) - (1 << 72) -
+                         2 * (1 << 64))
+
+    def test_fit_counts(self):
+        ipp = subnet.IPPool('10.10.0.0/24')
+        for prefixlen in [26, 30, 28, 32, 29]:
+            ipp.allocate_subnet(prefixlen)
+        for i in range(2):
+            self.assertEqual(ipp.largest_free_prefixlen, 25)
+            self.assertEqual(ipp.used_size, ipp.size - ipp.free_size)
+            # the same as counting the free aligned subnets
+            free = set(x for cidr in ipp.iter_cidrs() for x in cidr)
+            for prefixlen, count in ipp.fit_counts().items():
+                self.assertEqual(count, len([
+                    x for x in
+                    netaddr.IPNetwork('10.10.0.0/24').subnet(prefixlen)
+                    if all(ip in free for ip in x)]))
+            ipp.allocate_biggest_subnet()
+        self.assertEqual(list(ipp.fit_counts([24, 28])), [24, 28])
+
+
+class IpRangeAllocatorTest(_BaseTestCase):
+
+    def test_alloc_front_and_back(self):
+        ipr = subnet.IpRangeAllocator('10.10.0.0/28')
+        self.assertEqual(ipr.alloc(2), netaddr.IPRange('10.10.0.1',
+                                                       '10.10.0.2'))
+        self.assertEqual(ipr.alloc(3, from_the_back=True),
+                         netaddr.IPRange('10.10.0.12', '10.10.0.14'))
+        # the remaining addresses can all be allocated
+        self.assertEqual(ipr.alloc(9), netaddr.IPRange('10.10.0.3',
+                                                       '10.10.0.11'))
+        self.assertRaises(subnet.SubnettingError, ipr.alloc, 1)
+
+    def test_reserve_and_fit(self):
+        for best_fit, expected in [(False, '10.10.0.1'), (True, '10.10.0.8')]:
+            ipr = subnet.IpRangeAllocator('10.10.0.0/28', best_fit=best_fit)
+            ipr.reserve(netaddr.IPRange('10.10.0.5', '10.10.0.7'))
+            ipr.reserve(netaddr.IPRange('10.10.0.10', '10.10.0.14'))
+            self.assertEqual(ipr.free_fragments, 2)
+            self.assertEqual(ipr.largest_free_size, 4)
+            # free: .1-.4 and .8-.9
+            self.assertEqual(ipr.alloc(2).first,
+                             int(netaddr.IPAddress(expected)))
+            self.assertRaises(subnet.SubnettingError, ipr.reserve,
+                              netaddr.IPRange('10.10.0.4', '10.10.0.5'))
+
+    def test_first_and_last_fit_fragmented(self):
+        ipr = subnet.IpRangeAllocator('10.10.0.0/16')
+        base = int(netaddr.IPAddress('10.10.0.0'))
+        # free intervals of 3 IPs, with one of 7 IPs in the middle
+        for i in range(1, 65530, 4):
+            if i != 32001:
+                ipr.reserve_interval(base + i + 3, base + i + 3)
+        self.assertEqual(ipr.alloc_interval(4),
+                         (base + 32001, base + 32004))
+        self.assertEqual(ipr.alloc_interval(3, from_the_back=True),
+                         (base + 65529, base + 65531))
+        self.assertEqual(ipr.alloc_interval(3), (base + 1, base + 3))
+        self.assertRaises(subnet.SubnettingError, ipr.alloc_interval, 4)
+
+    def test_alloc_large_ipv6(self):
+        net = netaddr.IPNetwork('2001:db8::/64')
+        ipr = subnet.IpRangeAllocator(net)
+        # the network and the last IP are not used
+        self.assertEqual(ipr.alloc_interval(1 << 62),
+                         (net.first + 1, net.first + (1 << 62)))
+        self.assertEqual(ipr.alloc_interval(1 << 62, from_the_back=True),
+                         (net.last - (1 << 62), net.last - 1))
+        self.assertEqual(ipr.free_size, (1 << 63) - 2)
+
+
+class VlanPoolTest(_BaseTestCase):
+
+    def test_alloc_and_reserve(self):
+        vp = ipa.VlanPool(100, 110)
+        self.assertEqual([vp.alloc(), vp.alloc()], [100, 101])
+        self.assertEqual(vp.unused(), (102, 110))
+        vp.reserve(105)
+        self.assertRaises(ValueError, vp.reserve, 105)
+        self.assertRaises(ValueError, vp.reserve, 110)
+        self.assertEqual(vp.free_size, 7)
+        self.assertEqual(vp.largest_free_size, 4)
+        self.assertEqual(vp.unused(), [[102, 105], [106, 110]])
+        self.assertEqual([vp.alloc() for _ in range(4)], [102, 103, 104, 106])
+        self.assertEqual(vp.free_fragments, 1)
+
+    def test_alloc_exhausted(self):
+        vp = ipa.VlanPool(100, 102)
+        vp.reserve(101)
+        self.assertEqual(vp.alloc(), 100)
+        self.assertEqual((vp.free_fragments, vp.largest_free_size), (0, 0))
+        self.assertRaises(subnet.SubnettingError, vp.alloc)
+
+        d = ipa.load_input(bench.generate_input(nodes=4))
+        d['vlan_pool']['pool1']['end'] = d['vlan_pool']['pool1']['start'] + 2
+        with self.assertRaises(subnet.SubnettingError) as cm:
+            ipa.alloc_ips(d, {})
+        self.assertEqual(str(cm.exception),
+                         "No free VLAN left in the VLAN pool pool1")
+
+    def test_dict_round_trip(self):
+        vp = ipa.VlanPool(1, 4095)
+        for vid in [7, 8, 4000]:
+            vp.reserve(vid)
+        vp1 = ipa.dict_to_vlan_pool(
+            json.loads(json.dumps(ipa.vlan_pool_to_dict(vp))))
+        self.assertEqual(vp1.unused(), [[1, 7], [9, 4000], [4001, 4095]])
+        self.assertEqual(vp1.free_size, 4091)
+        self.assertTrue(vp1.is_allocated(8))
+        self.assertFalse(vp1.is_allocated(9))
+
+
+class AllocationTest(_BaseTestCase):
+
+    def test_dict_round_trip(self):
+        for cidr, start, end, gw in [
+                ('10.10.0.16/28', '10.10.0.17', '10.10.0.30', '10.10.0.30'),
+                ('2001:db8::/127', '2001:db8::', '2001:db8::1', None)]:
+            net = netaddr.IPNetwork(cidr)
+            a = allocation.Allocation(
+                net.version, net.first, net.prefixlen,
+                int(netaddr.IPAddress(start)), int(netaddr.IPAddress(end)),
+                int(netaddr.IPAddress(gw)) - net.first if gw else None,
+                100, {'desc': 'x'}, {'id': 1})
+            d = a.to_dict()
+            self.assertEqual(d['cidr'], str(net))
+            self.assertEqual(d['netmask'], str(net.netmask))
+            self.assertEqual(d['ip_range']['str'],
+                             str(netaddr.IPRange(start, end)))
+            self.assertEqual(d['gateway'], gw)
+            self.assertEqual(a['cidr'], net)
+            self.assertEqual(allocation.Allocation.from_dict(d).to_dict(), d)
+
+
+class ServerTest(_BaseTestCase):
+
+    def test_allocate_same_as_ipa(self):
+        d = ipa.load_input(bench.generate_input(nodes=20))
+        allocator = server.Allocator(d, {})
+        d2 = ipa.load_input(bench.generate_input(nodes=25))
+        new_nodes = OrderedDict((k, v) for k, v in d2['ipam'].items()
+                                if k not in d['ipam'])
+
+        # a failed allocation does not change the pools
+        bad = dict(new_nodes['node_20'],
+                   schema=[{'name': 'big', 'prefixlen': 8,
+                            'label': 'linknet'}])
+        res = allocator.handle({'op': 'allocate',
+                                'nodes': {'node_20': bad}})
+        self.assertFalse(res['ok'])
+        self.assertTrue(res['error'].startswith('SubnettingError'))
+
+        res = allocator.handle({'op': 'allocate', 'nodes': new_nodes})
+        self.assertTrue(res['ok'])
+        self.assertEqual(list(res['result']), list(new_nodes))
+        self.assertEqual(res['result']['node_24']['net_0'],
+                         allocator.handle({'op': 'lookup', 'node': 'node_24',
+                                           'entry': 'net_0'})['result'])
+
+        # the same as allocating the new nodes with ipa
+        p = ipa.objectify(json.loads(
+            json.dumps(ipa.deobjectify(ipa.alloc_ips(d2, {})))))
+        self.assertEqual(
+            json.loads(json.dumps(ipa.deobjectify(ipa.alloc_ips(d2, p)))),
+            json.loads(allocator.handle({'op': 'export'})['result']))
+
+    def test_socket(self):
+        state_file = self.tmp_path('state.json')
+        sock = self.tmp_path('ipa.sock')
+        input_file = self.write_input(nodes=5)
+        thread = threading.Thread(
+            target=server.main,
+            args=([input_file, '--first-run', '--socket', sock,
+                   '--state', state_file, '--sync-interval', '0'],))
+        thread.start()
+        for _ in range(100):
+            if os.path.exists(sock):
+                break
+            time.sleep(0.05)
+        # a connection left open does not block the other clients
+        idle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        idle.connect(sock)
+        res = server.request(sock, {'op': 'lookup', 'node': 'node_1'})
+        self.assertEqual(list(res['result']),
+                         ['net_0', 'net_1', 'net_2', 'net6',
+                          'local_range', 'shared_range'])
+        self.assertEqual(server.request(sock, {'op': 'foo'}),
+                         {'ok': False,
+                          'error': 'ValueError: Unknown operation: foo'})
+        self.assertEqual(server.request(sock, {'op': 'lookup'}),
+                         {'ok': False, 'error': "ValueError: Missing "
+                                                "'node' in the request"})
+        self.assertEqual(
+            server.request(sock, {'op': 'allocate', 'nodes': {
+                'node_1': {'schema': []}}}),
+            {'ok': False, 'error': 'ValueError: Deleting the entries of '
+                                   'node_1 is not supported'})
+        # the socket of a running server is not taken over
+        self.assertRaises(ValueError, server.Server, sock, None)
+        self.assertRaises(ValueError, server.Server, input_file, None)
+        self.assertEqual(server.request(sock, {'op': 'shutdown'}),
+                         {'ok': True, 'result': None})
+        thread.join()
+        idle.close()
+        self.assertEqual(
+            json.loads(ipa.main([input_file, '-p', state_file,
+                                 '-o', 'json'])),
+            json.loads(ipa.main([input_file, '--first-run',
+                                 '-o', 'json'])))
+
+
+class StoreTest(_BaseTestCase):
+
+    def setUp(self):
+        self.db = self.tmp_path('ipa.db')
+
+    def test_same_as_previous_json(self):
+        tc_name = 'with_previous_basic_change'
+        input_file = get_path_to_resource_file(tc_name, 'input.yaml')
+        prev_file = get_path_to_resource_file(tc_name, 'previous.json')
+        store.main([self.db, 'import', prev_file])
+        res = ipa.main([input_file, '--store', self.db, '-o', 'json'])
+        with open(get_path_to_resource_file(tc_name, 'output.json')) as f:
+            self.assertEqualWithDiff(f.read().strip(), res.strip())
+
+        export_file = self.tmp_path('export.json')
+        store.main([self.db, 'export', '--output', export_file])
+        with open(export_file) as f:
+            self.assertEqual(json.load(f), json.loads(res))
+
+    def test_incremental_runs(self):
+        prev_file = self.tmp_path('previous.json')
+        input_file = self.write_input(nodes=10)
+        ipa.main([input_file, '--store', self.db, '-o', 'json'])
+        ipa.main([input_file, '--first-run', '-o', 'json',
+                  '--output', prev_file])
+        self.write_input(nodes=12)
+        for args in [[], ['--resume']]:
+            self.assertEqual(
+                json.loads(ipa.main([input_file, '--store', self.db,
+                                     '-o', 'json'] + args)),
+                json.loads(ipa.main([input_file, '-p', prev_file,
+                                     '-o', 'json'] + args)))
+
+        db = store.Store(self.db)
+        try:
+            # only the requested nodes and pools are loaded
+            d = db.load(['node_3', 'node_11'], ['main_net'], [])
+            self.assertEqual(list(d['ipam']), ['node_3', 'node_11'])
+            self.assertEqual(list(d['ip_pool']), ['main_net'])
+            self.assertEqual(d['vlan_pool'], {})
+
+            net = d['ipam']['node_3']['ipa']['net_0']
+            self.assertEqual(
+                [x[:2] for x in db.find_subnets(net.version, net.network,
+                                                net.last())],
+                [('node_3', 'net_0'), ('node_3', 'local_range')])
+            self.assertEqual([x[:2] for x in db.find_vlan(net.vlan)],
+                             [('node_3', 'net_0')])
+        finally:
+            db.close()
+
+
+class LookupTest(_BaseTestCase):
+
+    def test_queries(self):
+        index = lookup.Index(path=get_path_to_resource_file(
+            'with_previous_basic_change', 'output.json'))
+
+        def keys(entries):
+            return [x[:2] for x in entries]
+
+        self.assertEqual(keys(index.find_ip('10.10.1.5')),
+                         [('shared_net', 'pool_net'),
+                          ('foo_1', 'shared_range')])
+        self.assertEqual(keys(index.find_ip('10.10.0.9')),
+                         [('foo_1', 'vip_1')])
+        self.assertEqual(keys(index.find_ip('192.168.0.1')), [])
+        self.assertEqual(keys(index.find_inside('10.10.0.0/28')),
+                         [('foo_1', 'ln_1'), ('foo_1', 'reserved_vip_1'),
+                          ('foo_1', 'vip_1'), ('foo_2', 'reserved_vip_1'),
+                          ('foo_2', 'vip_1'), ('bar_1', 'reserved_vip_1'),
+                          ('bar_1', 'vip_1'), ('bar_1', 'vip_2'),
+                          ('bar_2', 'reserved_vip_1')])
+        self.assertEqual(keys(index.find_overlapping('10.10.1.40-10.10.1.42')),
+                         [('shared_net', 'pool_net'),
+                          ('shared_net', 'reserved_range'),
+                          ('bar_1', 'shared_range'),
+                          ('bar_2', 'shared_range')])
+        self.assertEqual(keys(index.find_vlan(101)), [('foo_1', 'ln_2')])
+
+    def test_same_as_scan(self):
+        d = ipa.alloc_ips(ipa.load_input(bench.generate_input(nodes=50)), {})
+        index = lookup.Index(d['ipam'])
+        entries = [(k, k1, v) for k, node in d['ipam'].items()
+                   for k1, v in node['ipa'].items()]
+
+        def interval(v):
+            if v.metadata['type'] == 'ip_range':
+                return lookup.parse_query(v.ip_range_str())
+            return lookup.parse_query(v.cidr_str())
+
+        for query in ['10.0.0.0/10', '10.64.0.0/29', '10.64.0.8/29',
+                      '10.0.0.5', '10.128.0.0/16', '2001:db8::/40',
+                      '2001:db8:0:1::/64', '10.0.0.0-10.0.0.200']:
+            first, last = lookup.parse_query(query)
+            self.assertEqual(
+                [x[:2] for x in index.find_overlapping(query)],
+                [x[:2] for x in sorted(
+                    (x for x in entries if interval(x[2])[0] <= last and
+                     interval(x[2])[1] >= first),
+                    key=lambda x: (interval(x[2])[0],
+                                   x[2].metadata['type'] == 'ip_range'))])
+            self.assertEqual(
+                set(x[:2] for x in index.find_inside(query)),
+                set(x[:2] for x in entries if interval(x[2])[0] >= first and
+                    interval(x[2])[1] <= last))
+
+
 if __name__ == "__main__":
     suite = unittest.TestSuite()
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(IpaTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(IPPoolTest))
+    suite.addTest(
+        unittest.TestLoader().loadTestsFromTestCase(IpRangeAllocatorTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(VlanPoolTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(AllocationTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ServerTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(StoreTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(LookupTest))
     unittest.TextTestRunner().run(suite)
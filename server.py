@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+
+"""A long-running ipa process that keeps the IP and VLAN pools in memory
+
+Instead of loading the input and the previous allocation and allocating
+all the entries again for every change, the server loads them once and
+then allocates the new entries on request, from the pools kept in memory.
+
+The server listens on a Unix socket. Each request and each response is a
+json object on a single line; a connection can send several requests. The
+connections are served in parallel (a connection idle for more than
+CLIENT_TIMEOUT seconds is closed) but the requests are handled one at a
+time. The requests have an 'op' key:
+
+    {"op": "allocate", "nodes": {"<node>": <node>, ...}}
+        allocate the entries of the given ipam nodes (in the format of the
+        ipam section of the input) which are not allocated yet; a node
+        which exists already is replaced but its allocated entries are
+        kept. Returns the new entries, in the format of the json output
+    {"op": "lookup", "node": "<node>", "entry": "<entry>"}
+        return an entry, or all the entries of a node if 'entry' is not
+        given, in the format of the json output
+    {"op": "export", "format": "json"}
+        return the whole allocation in the given output format (json by
+        default); the snapshot format is not supported, as it is binary
+    {"op": "save"}
+        write the allocation to the state file (--state) now
+    {"op": "shutdown"}
+        save the allocation to the state file and stop the server
+
+The responses are {"ok": true, "result": ...} or {"ok": false,
+"error": "<message>"}. An allocation which fails leaves the pools as they
+were before the request.
+
+The allocation is written to the state file (--state), in json format,
+at most every --sync-interval seconds when it changed (or after each
+allocation with --sync), and on save and shutdown, so it can be used as
+the previous allocation (-p) of ipa or of the server.
+"""
+
+from collections import OrderedDict
+import argparse
+import copy
+import errno
+import json
+import os
+import socket
+import stat
+import sys
+import threading
+import time
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import ipa
+
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
+# the seconds after which an idle connection is closed
+CLIENT_TIMEOUT = 60
+
+# the seconds after which the server checks if it is stopping or if the
+# allocation has to be saved, when there are no new connections
+POLL_INTERVAL = 0.5
+
+
+def _field(request, key, types, default=None, required=True):
+    """Return the value of a key of a request, checking its type
+
+    :raises: ValueError if the key is missing (and required) or if its
+        value does not have one of the given types
+    """
+    if key not in request:
+        if required:
+            raise ValueError("Missing '{}' in the request".format(key))
+        return default
+    if not isinstance(request[key], types):
+        raise ValueError("Invalid '{}' in the request".format(key))
+    return request[key]
+
+
+class Allocator(object):
+    """The state of the server: the input, the allocation and the pools"""
+
+    def __init__(self, d, p, resume=False, state_file=None, sync=False):
+        """
+        :param d: the content of the input file as dict
+        :param p: the result of a previous allocation as dict
+        :param resume: restore the pools from the previous allocation
+            (see alloc_ips())
+        :param state_file: the json file the allocation is saved to
+        :param sync: save the allocation after each allocation request
+        """
+        self.d = d
+        self.ipr = {}
+        self.result = ipa.alloc_ips(d, p, resume, ip_ranges=self.ipr)
+        self.state_file = state_file
+        self.sync = sync
+        # the requests are handled one at a time
+        self.lock = threading.RLock()
+        # the allocation changed since it was last saved
+        self.dirty = False
+
+        # the Allocation of each entry, by (node, entry name)
+        self.allocated = {}
+        for k, v in self.result['ipam'].items():
+            for k1, v1 in v['ipa'].items():
+                self.allocated[(k, k1)] = v1
+        self.last_id = max([x.metadata['id']
+                            for x in self.allocated.values()] or [0])
+
+    def handle(self, request):
+        """Handle a request and return the response, as dicts"""
+        try:
+            if not isinstance(request, dict):
+                raise ValueError("The request is not a json object")
+            op = request.get('op')
+            with self.lock:
+                if op == 'allocate':
+                    res = self.allocate(_field(request, 'nodes', dict))
+                elif op == 'lookup':
+                    res = self.lookup(
+                        _field(request, 'node', _string_types),
+                        _field(request, 'entry', _string_types,
+                               required=False))
+                elif op == 'export':
+                    res = self.export(_field(request, 'format', _string_types,
+                                             'json', required=False))
+                elif op in ('save', 'shutdown'):
+                    res = self.save()
+                else:
+                    raise ValueError("Unknown operation: {}".format(op))
+        except Exception as e:
+            return {'ok': False,
+                    'error': "{}: {}".format(e.__class__.__name__, e)}
+        return {'ok': True, 'result': res}
+
+    def allocate(self, nodes):
+        """Allocate the new entries of the given nodes
+
+        :param nodes: dict of node name -> node, in the format of the ipam
+            section of the input
+        :return: the new entries in the format of the json output, by node
+            and entry name
+        """
+        for k, v in nodes.items():
+            if not isinstance(v, dict) or \
+                    not isinstance(v.get('schema'), list) or \
+                    not all(isinstance(s, dict) and 'name' in s
+                            for s in v['schema']):
+                raise ValueError("Invalid node {}".format(k))
+            names = set(s['name'] for s in v['schema'])
+            old = self.result['ipam'].get(k, {}).get('ipa', {})
+            if not all(x in names for x in old):
+                raise ValueError(
+                    "Deleting the entries of {} is not supported".format(k))
+
+        # the new entries, with the ids following the ones used so far
+        _, new = ipa.filter_entries({'ipam': nodes}, {'ipam': dict(
+            (k, self.result['ipam'][k]) for k in nodes
+            if k in self.result['ipam'])})
+        last_id = self.last_id
+        for v in new.values():
+            last_id += 1
+            v.metadata['id'] = last_id
+
+        # the node definitions are replaced before the allocation as they
+        # are used to find the pools of the entries
+        prev_nodes = dict((k, self.d['ipam'].get(k)) for k in nodes)
+        self.d['ipam'].update(nodes)
+        saved = None
+        try:
+            # save the pools used by the new entries, to restore them if
+            # the allocation fails
+            saved = self._copy_pools(new)
+            ipa.alloc_entries(self.d, {}, self.result['ip_pool'],
+                              self.result['vlan_pool'], {}, new,
+                              allocated=self.allocated, ip_ranges=self.ipr)
+        except Exception:
+            if saved is not None:
+                self._restore_pools(saved)
+            for k in new:
+                self.allocated.pop(k, None)
+            for k, v in prev_nodes.items():
+                if v is None:
+                    del self.d['ipam'][k]
+                else:
+                    self.d['ipam'][k] = v
+            raise
+
+        self.last_id = last_id
+        for k, v in nodes.items():
+            self.result['ipam'][k] = {
+                'properties': v.get('properties', {}),
+                'ipa': OrderedDict((s['name'], self.allocated[(k, s['name'])])
+                                   for s in v['schema']),
+            }
+        self.dirty = True
+        if self.sync:
+            self.save()
+
+        res = OrderedDict()
+        for k in new:
+            res.setdefault(k[0], OrderedDict())[k[1]] = \
+                self.allocated[k].to_dict()
+        return res
+
+    def _copy_pools(self, entries):
+        """Copy the IP pools, VLAN pools and IP range allocators used by
+        the given entries"""
+        ipp = {}
+        vp = {}
+        ipr = {}
+        for k, s in entries.items():
+            if s.parent is not None:
+                if s.parent not in ipr:
+                    ipr[s.parent] = copy.deepcopy(self.ipr.get(s.parent))
+                continue
+            if s.subnet in self.result['ip_pool'] and s.subnet not in ipp:
+                ipp[s.subnet] = copy.deepcopy(self.result['ip_pool'][s.subnet])
+            if s.vlan_pool in self.result['vlan_pool'] and \
+                    s.vlan_pool not in vp:
+                vp[s.vlan_pool] = copy.deepcopy(
+                    self.result['vlan_pool'][s.vlan_pool])
+        return ipp, vp, ipr
+
+    def _restore_pools(self, saved):
+        ipp, vp, ipr = saved
+        self.result['ip_pool'].update(ipp)
+        self.result['vlan_pool'].update(vp)
+        for k, v in ipr.items():
+            # the allocator did not exist before the request
+            if v is None:
+                self.ipr.pop(k, None)
+            else:
+                self.ipr[k] = v
+
+    def lookup(self, node, entry=None):
+        """Return an entry, or all the entries of a node, in the format of
+        the json output"""
+        entries = self.result['ipam'][node]['ipa']
+        if entry is not None:
+            return entries[entry].to_dict()
+        return OrderedDict((k, v.to_dict()) for k, v in entries.items())
+
+    def export(self, output_format='json'):
+        """Return the allocation in the given output format"""
+        if output_format not in ('json', 'yaml-anchors', 'human', 'report',
+                                 'diff'):
+            raise ValueError("Unsupported output format: {}"
+                             .format(output_format))
+        d = self.result
+        if output_format == 'yaml-anchors':
+            # to_yaml_anchors() converts the entries and the pools in place
+            d = dict(d, ipam=OrderedDict(
+                (k, dict(v, ipa=OrderedDict(v['ipa'])))
+                for k, v in d['ipam'].items()),
+                ip_pool=dict(d['ip_pool']), vlan_pool=dict(d['vlan_pool']))
+        f = StringIO()
+        ipa.write_output(d, output_format, f)
+        return f.getvalue()
+
+    def save(self):
+        """Write the allocation to the state file, if any"""
+        with self.lock:
+            if self.state_file:
+                with open(self.state_file + '.tmp', 'w') as f:
+                    ipa.write_output(self.result, 'json', f)
+                # replace the file only when it is complete
+                os.rename(self.state_file + '.tmp', self.state_file)
+            self.dirty = False
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    # close the idle connections
+    timeout = CLIENT_TIMEOUT
+
+    def handle(self):
+        allocator = self.server.allocator
+        while not self.server.stopping:
+            try:
+                line = self.rfile.readline()
+            except socket.timeout:
+                break
+            if not line:
+                break
+            try:
+                req = json.loads(line.decode('utf-8'),
+                                 object_pairs_hook=OrderedDict)
+            except ValueError as e:
+                req = {}
+                response = {'ok': False,
+                            'error': "Invalid request: {}".format(e)}
+            else:
+                response = allocator.handle(req)
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+            if isinstance(req, dict) and req.get('op') == 'shutdown' and \
+                    response['ok']:
+                self.server.stopping = True
+                break
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serve the requests to an Allocator on a Unix socket, with a thread
+    per connection"""
+
+    # the connections left open do not keep the process running
+    daemon_threads = True
+
+    def __init__(self, path, allocator, sync_interval=None):
+        """
+        :param path: the Unix socket to listen on
+        :param allocator: the Allocator serving the requests
+        :param sync_interval: save the allocation at most every
+            sync_interval seconds when it changed (never if None)
+        """
+        _remove_stale_socket(path)
+        socketserver.UnixStreamServer.__init__(self, path, _RequestHandler)
+        self.allocator = allocator
+        self.stopping = False
+        # wake up to stop or save the allocation even if there are no new
+        # connections
+        self.timeout = POLL_INTERVAL
+        self.sync_interval = sync_interval
+
+    def serve(self):
+        """Serve the requests until a shutdown request"""
+        last_save = time.time()
+        try:
+            while not self.stopping:
+                self.handle_request()
+                if self.sync_interval is None or not self.allocator.dirty:
+                    last_save = time.time()
+                elif time.time() - last_save >= self.sync_interval:
+                    self.allocator.save()
+                    last_save = time.time()
+        finally:
+            self.server_close()
+            os.remove(self.server_address)
+
+
+def _remove_stale_socket(path):
+    """Remove the socket left by a server which is not running anymore
+
+    Raise an error if the path is not a socket or if a server is listening
+    on it.
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+    if not stat.S_ISSOCK(mode):
+        raise ValueError("{} exists and is not a socket".format(path))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        if e.errno != errno.ECONNREFUSED:
+            raise
+    else:
+        raise ValueError("{} is in use by another server".format(path))
+    finally:
+        sock.close()
+    os.remove(path)
+
+
+def request(path, req):
+    """Send a request to the server listening on the given socket and
+    return the response"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(req).encode('utf-8') + b'\n')
+        f = sock.makefile('rb')
+        try:
+            return json.loads(f.readline().decode('utf-8'),
+                              object_pairs_hook=OrderedDict)
+        finally:
+            f.close()
+    finally:
+        sock.close()
+
+
+def main(input_args):
+    parser = argparse.ArgumentParser(
+        description='Basic IPAM tool, as a server keeping the allocation '
+                    'in memory')
+    parser.add_argument(dest="input_file",
+                        help='the input file in yaml format')
+    parser.add_argument('--socket',
+                        dest="socket",
+                        required=True,
+                        metavar="PATH",
+                        help='the Unix socket to listen on')
+
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-p',
+                       dest="previous_alloc",
+                       metavar="FILE.json",
+                       help='the result of a previous run/allocation, '
+                            'in json or snapshot format.')
+    group.add_argument('--first-run',
+                       dest="is_first_run",
+                       action="store_true",
+                       help="there are no previous ip allocations that have "
+                            "to be preserved")
+
+    parser.add_argument('--resume',
+                        dest="resume",
+                        action="store_true",
+                        help="restore the IP and VLAN pools from the "
+                             "previous allocation (-p) instead of allocating "
+                             "the old entries again")
+    parser.add_argument('--state',
+                        dest="state_file",
+                        metavar="FILE.json",
+                        help='save the allocation to FILE.json, in json '
+                             'format, when it changed')
+    parser.add_argument('--sync',
+                        dest="sync",
+                        action="store_true",
+                        help='save the allocation to the state file after '
+                             'each allocation')
+    parser.add_argument('--sync-interval',
+                        dest="sync_interval",
+                        type=float,
+                        default=5.0,
+                        metavar="SECONDS",
+                        help='save the changed allocation to the state file '
+                             'at most every SECONDS seconds (default: 5; 0 '
+                             'to only save on save and shutdown requests)')
+    args = parser.parse_args(input_args)
+
+    if args.resume and not args.previous_alloc:
+        parser.error("--resume requires a previous allocation (-p)")
+
+    with open(args.input_file) as f:
+        d = ipa.load_input(f)
+    p = ipa.load_previous(args.previous_alloc) if args.previous_alloc else {}
+
+    allocator = Allocator(d, p, args.resume, args.state_file, args.sync)
+    allocator.save()
+    try:
+        server = Server(args.socket, allocator, args.sync_interval or None)
+    except ValueError as e:
+        parser.error(str(e))
+    server.serve()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,300 @@
+"""A compact binary format for the result of an allocation
+
+The snapshot is an alternative to the json output (-o json / -p FILE.json)
+for big IP plans. The IP addresses are stored as packed integers in
+fixed size columns and the names as indexes in a string table, so the
+file can be memory mapped and the entries decoded only when accessed.
+
+Layout (all integers are little endian, except the IP addresses which are
+stored as 128 bit big endian integers):
+
+    header:  MAGIC, then the counts and the offsets of the sections
+    columns: one array per entry column (see ENTRY_COLUMNS)
+    nodes:   one (name, properties, first entry, entry count) per ipam node
+    index:   the indexes of the nodes, sorted by node name
+    strings: the offset of each string, then the utf-8 encoded strings
+
+The metadata of the entries (except the id) and their properties are
+stored as json strings in the string table. The global properties and the
+ip_pool / vlan_pool sections (in the format produced by ip_pool_to_dict()
+and vlan_pool_to_dict()) are stored as a single json string.
+"""
+
+import json
+import mmap
+import struct
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from allocation import Allocation
+
+MAGIC = b'IPASNAP1'
+
+# the columns of the entries: (name, struct format)
+ENTRY_COLUMNS = [
+    ('name', 'I'),
+    ('id', 'I'),
+    ('flags', 'B'),
+    ('metadata', 'I'),
+    ('prefixlen', 'B'),
+    ('vlan', 'I'),
+    ('properties', 'I'),
+    ('cidr', '16s'),
+    ('range_start', '16s'),
+    ('range_end', '16s'),
+    ('gateway', '16s'),
+]
+
+NODE = struct.Struct('<IIII')
+
+# header: the number of entries, nodes and strings, the string index of
+# the json with the other sections, the offset of the nodes, of the node
+# index, of the string offsets, of the string data and of each entry column
+HEADER = struct.Struct('<IIII' + 'Q' * (4 + len(ENTRY_COLUMNS)))
+
+# the entry flags
+IPV6 = 1
+HAS_GATEWAY = 2
+HAS_VLAN = 4
+
+
+def _pack_ip(value):
+    return struct.pack('>QQ', value >> 64, value & 0xffffffffffffffff)
+
+
+def _unpack_ip(data, offset):
+    hi, lo = struct.unpack_from('>QQ', data, offset)
+    return hi << 64 | lo
+
+
+def is_snapshot(path):
+    """Check if the given file is a snapshot"""
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def dump(d, f):
+    """Write the result of an allocation to a (binary) file as a snapshot
+
+    :param d: the result of alloc_ips(), with the ip_pool and vlan_pool
+        sections already converted to dicts
+    :param f: a file opened in binary mode
+    """
+    strings = {}
+
+    def sid(s):
+        if s not in strings:
+            strings[s] = len(strings)
+        return strings[s]
+
+    columns = dict((name, bytearray()) for name, _ in ENTRY_COLUMNS)
+    formats = dict((name, struct.Struct('<' + fmt))
+                   for name, fmt in ENTRY_COLUMNS)
+
+    def add(name, value):
+        columns[name] += formats[name].pack(value)
+
+    nodes = bytearray()
+    node_names = []
+    count = 0
+    for node_k, node in d['ipam'].items():
+        node_names.append(node_k.encode('utf-8'))
+        nodes += NODE.pack(sid(node_k),
+                           sid(json.dumps(node.get('properties', {}))),
+                           count, len(node['ipa']))
+        for k, v in node['ipa'].items():
+            # the metadata without the id is the same for many entries
+            # so it is stored in the string table
+            metadata = dict((k1, v1) for k1, v1 in v.metadata.items()
+                            if k1 != 'id')
+            flags = 0
+            if v.version == 6:
+                flags |= IPV6
+            if v.gateway_offset is not None:
+                flags |= HAS_GATEWAY
+            if v.vlan is not None:
+                flags |= HAS_VLAN
+
+            add('name', sid(k))
+            add('id', v.metadata['id'])
+            add('flags', flags)
+            add('metadata', sid(json.dumps(metadata, sort_keys=True)))
+            add('prefixlen', v.prefixlen)
+            add('vlan', v.vlan or 0)
+            add('properties', sid(json.dumps(v.properties)))
+            add('cidr', _pack_ip(v.network))
+            add('range_start', _pack_ip(v.range_first))
+            add('range_end', _pack_ip(v.range_last))
+            add('gateway', _pack_ip(v.network + v.gateway_offset
+                                    if v.gateway_offset is not None else 0))
+            count += 1
+
+    other = dict((k, v) for k, v in d.items() if k != 'ipam')
+    other_sid = sid(json.dumps(other))
+
+    # the strings, in the order of their index
+    data = [s.encode('utf-8') for s, _ in
+            sorted(strings.items(), key=lambda x: x[1])]
+    offsets = [0]
+    for s in data:
+        offsets.append(offsets[-1] + len(s))
+
+    # calculate the offsets of the sections
+    pos = len(MAGIC) + HEADER.size
+    column_offsets = []
+    for name, _ in ENTRY_COLUMNS:
+        column_offsets.append(pos)
+        pos += len(columns[name])
+    nodes_offset = pos
+    pos += len(nodes)
+    index_offset = pos
+    pos += 4 * len(node_names)
+    string_offsets_offset = pos
+    pos += 8 * len(offsets)
+
+    f.write(MAGIC)
+    f.write(HEADER.pack(count, len(d['ipam']), len(data), other_sid,
+                        nodes_offset, index_offset, string_offsets_offset,
+                        pos, *column_offsets))
+    for name, _ in ENTRY_COLUMNS:
+        f.write(bytes(columns[name]))
+    f.write(bytes(nodes))
+    f.write(struct.pack(
+        '<{}I'.format(len(node_names)),
+        *sorted(range(len(node_names)), key=lambda i: node_names[i])))
+    f.write(struct.pack('<{}Q'.format(len(offsets)), *offsets))
+    for s in data:
+        f.write(s)
+
+
+def load(path):
+    """Load a snapshot
+
+    The file is memory mapped and the ipam entries are only decoded when
+    they are accessed.
+
+    :return: the result of the allocation as dict, in the same format as
+        the json output converted by objectify(), except the ip_pool and
+        vlan_pool sections which are left as dicts
+    """
+    snapshot = Snapshot(path)
+    d = json.loads(snapshot.string(snapshot.other_sid))
+    d['ipam'] = snapshot
+    return d
+
+
+class Snapshot(Mapping):
+    """The ipam section of a snapshot: a read-only mapping of node names to
+    nodes, decoded on access"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._data[:len(MAGIC)] != MAGIC:
+            raise ValueError("'{}' is not a snapshot file".format(path))
+
+        header = HEADER.unpack_from(self._data, len(MAGIC))
+        (self.entry_count, self.node_count, self.string_count,
+         self.other_sid, self._nodes_offset, self._index_offset,
+         self._string_offsets_offset, self._strings_offset) = header[:8]
+        self._columns = dict(
+            (name, (offset, struct.Struct('<' + fmt)))
+            for (name, fmt), offset in zip(ENTRY_COLUMNS, header[8:]))
+
+    def _raw_string(self, i):
+        start, end = struct.unpack_from(
+            '<QQ', self._data, self._string_offsets_offset + 8 * i)
+        return self._data[self._strings_offset + start:
+                          self._strings_offset + end]
+
+    def string(self, i):
+        """Decode the string with the given index"""
+        return self._raw_string(i).decode('utf-8')
+
+    def column(self, name, i):
+        """Decode the value of a column for the entry with the given index"""
+        offset, fmt = self._columns[name]
+        return fmt.unpack_from(self._data, offset + fmt.size * i)[0]
+
+    def _ip(self, name, i):
+        offset, fmt = self._columns[name]
+        return _unpack_ip(self._data, offset + fmt.size * i)
+
+    def node(self, i):
+        """Decode the node with the given index: (name, properties string
+        index, index of the first entry, number of entries)"""
+        return NODE.unpack_from(self._data, self._nodes_offset + NODE.size * i)
+
+    def entry(self, i):
+        """Decode the entry with the given index, as Allocation"""
+        flags = self.column('flags', i)
+        network = self._ip('cidr', i)
+        metadata = json.loads(self.string(self.column('metadata', i)))
+        metadata['id'] = self.column('id', i)
+
+        return Allocation(
+            6 if flags & IPV6 else 4, network, self.column('prefixlen', i),
+            self._ip('range_start', i), self._ip('range_end', i),
+            self._ip('gateway', i) - network if flags & HAS_GATEWAY else None,
+            self.column('vlan', i) if flags & HAS_VLAN else None,
+            json.loads(self.string(self.column('properties', i))),
+            metadata)
+
+    def _find_node(self, k):
+        """Binary search a node by name in the node index"""
+        key = k.encode('utf-8')
+        lo, hi = 0, self.node_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = struct.unpack_from('<I', self._data,
+                                   self._index_offset + 4 * mid)[0]
+            name = self._raw_string(self.node(i)[0])
+            if name == key:
+                return i
+            elif name < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        raise KeyError(k)
+
+    def __getitem__(self, k):
+        _, properties, first, count = self.node(self._find_node(k))
+        return {
+            'properties': json.loads(self.string(properties)),
+            'ipa': SnapshotEntries(self, first, count),
+        }
+
+    def __iter__(self):
+        for i in range(self.node_count):
+            yield self.string(self.node(i)[0])
+
+    def __len__(self):
+        return self.node_count
+
+
+class SnapshotEntries(Mapping):
+    """The entries of a node in a snapshot: a read-only mapping of entry
+    names to entries, decoded on access"""
+
+    def __init__(self, snapshot, first, count):
+        self._snapshot = snapshot
+        self._first = first
+        self._count = count
+        self._index = None
+
+    def __getitem__(self, k):
+        if self._index is None:
+            self._index = dict(
+                (self._snapshot.string(self._snapshot.column('name', i)), i)
+                for i in range(self._first, self._first + self._count))
+        return self._snapshot.entry(self._index[k])
+
+    def __iter__(self):
+        for i in range(self._first, self._first + self._count):
+            yield self._snapshot.string(self._snapshot.column('name', i))
+
+    def __len__(self):
+        return self._count
@@ -0,0 +1,161 @@
+"""Timing and allocation statistics for ipa runs
+
+A Stats object is passed to ipa.main() (or enabled with --stats) to collect
+the wall time of each phase of a run and, at the end of the allocation,
+the counters of the IP pools, IP range allocators and VLAN pools.
+When no Stats object is used, NO_STATS is used instead, which does nothing.
+"""
+
+from collections import OrderedDict
+import json
+import sys
+import timeit
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+class _Phase(object):
+    """Context manager adding the time spent in it to a phase"""
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+
+    def __exit__(self, *exc):
+        phases = self.stats.phases
+        phases[self.name] = phases.get(self.name, 0) + \
+            timeit.default_timer() - self.start
+
+
+class _NoPhase(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+class Stats(object):
+
+    def __init__(self):
+        # phase name -> wall time in seconds, in the order of the phases
+        self.phases = OrderedDict()
+        self.ip_pools = OrderedDict()
+        self.ip_ranges = OrderedDict()
+        self.vlan_pools = OrderedDict()
+
+    def phase(self, name):
+        """Time a phase of the run: with stats.phase('name'): ...
+
+        The time of the phases with the same name is added up.
+        """
+        return _Phase(self, name)
+
+    def add_phases(self, phases, prefix):
+        """Add up the time of the phases of another process (e.g. of the
+        processes of ipa -j) in the phases named prefix + name
+
+        The phases with a '/' in their name are part of another phase and
+        are not counted in the total.
+        """
+        for k, v in phases.items():
+            k = prefix + k
+            self.phases[k] = self.phases.get(k, 0) + v
+
+    @staticmethod
+    def _counters(pool):
+        return OrderedDict([
+            ('allocations', pool.allocations),
+            ('free_fragments', pool.free_fragments),
+            ('free_size', pool.free_size),
+        ])
+
+    def add_pools(self, ip_pools, ip_ranges, vlan_pools):
+        """Save the counters of the pools used in the allocation
+
+        :param ip_pools: dict of subnet name -> IPPool
+        :param ip_ranges: dict of parent entry key -> IpRangeAllocator
+        :param vlan_pools: dict of VLAN pool name -> VlanPool
+        """
+        for k, v in ip_pools.items():
+            self.ip_pools[k] = self._counters(v)
+        for k, v in ip_ranges.items():
+            self.ip_ranges['.'.join(k)] = self._counters(v)
+        for k, v in vlan_pools.items():
+            self.vlan_pools[k] = self._counters(v)
+
+    @staticmethod
+    def peak_memory():
+        """The peak memory usage of the process in KB (None if unknown)"""
+        if resource is None:
+            return None
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in KB elsewhere
+        return rss // 1024 if sys.platform == 'darwin' else rss
+
+    def to_dict(self):
+        return OrderedDict([
+            ('phases', self.phases),
+            ('total', sum(v for k, v in self.phases.items()
+                          if '/' not in k)),
+            ('peak_memory_kb', self.peak_memory()),
+            ('ip_pools', self.ip_pools),
+            ('ip_ranges', self.ip_ranges),
+            ('vlan_pools', self.vlan_pools),
+        ])
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_text(self):
+        d = self.to_dict()
+        lines = ["Phases:"]
+        for k, v in d['phases'].items():
+            lines.append("  {:<20} {:10.3f}s".format(k, v))
+        lines.append("  {:<20} {:10.3f}s".format('total', d['total']))
+        lines.append("Peak memory: {} KB".format(d['peak_memory_kb']))
+
+        def pools(title, pools_):
+            lines.append(title)
+            for k, v in pools_.items():
+                lines.append(
+                    "  {}: {} allocations, {} free fragments, {} free"
+                    .format(k, v['allocations'], v['free_fragments'],
+                            v['free_size']))
+
+        pools("IP pools:", d['ip_pools'])
+        pools("VLAN pools:", d['vlan_pools'])
+        # there is an IP range allocator per parent subnet, so only
+        # the totals are shown
+        lines.append(
+            "IP ranges: {} parent subnets, {} allocations, "
+            "{} free fragments".format(
+                len(d['ip_ranges']),
+                sum(v['allocations'] for v in d['ip_ranges'].values()),
+                sum(v['free_fragments'] for v in d['ip_ranges'].values())))
+        return "\n".join(lines)
+
+
+class _NoStats(object):
+    """Stats which are not collected"""
+
+    _no_phase = _NoPhase()
+
+    def phase(self, name):
+        return self._no_phase
+
+    def add_phases(self, phases, prefix):
+        pass
+
+    def add_pools(self, ip_pools, ip_ranges, vlan_pools):
+        pass
+
+
+NO_STATS = _NoStats()
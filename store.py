@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+"""An SQLite database for the previous and the current allocation
+
+The store is an alternative to the json file of the previous allocation
+(-p FILE.json). A run only loads the nodes and the pools of its input and
+writes its result back in a single transaction, which is started before
+the previous allocation is loaded (BEGIN IMMEDIATE), so concurrent runs
+using the same store wait for each other instead of overwriting each
+other's allocations. Several inputs (e.g. one per site) can share a store.
+
+The entries are indexed by node and entry name, by subnet (IP version and
+first IP) and by VLAN. The IP addresses are stored as 128 bit big endian
+blobs, which are sorted like the addresses.
+
+The ip_pool and vlan_pool sections are stored (and returned) as dicts, in
+the format produced by ip_pool_to_dict() and vlan_pool_to_dict().
+"""
+
+from collections import OrderedDict
+import argparse
+import contextlib
+import json
+import sqlite3
+import struct
+import sys
+
+from allocation import Allocation
+import snapshot
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS node (
+    name TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    properties TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entry (
+    node TEXT NOT NULL,
+    name TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    network BLOB NOT NULL,
+    prefixlen INTEGER NOT NULL,
+    range_first BLOB NOT NULL,
+    range_last BLOB NOT NULL,
+    gateway BLOB,
+    vlan INTEGER,
+    properties TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    PRIMARY KEY (node, name)
+);
+CREATE INDEX IF NOT EXISTS entry_network ON entry (version, network);
+CREATE INDEX IF NOT EXISTS entry_vlan ON entry (vlan);
+CREATE TABLE IF NOT EXISTS ip_pool (
+    name TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS vlan_pool (
+    name TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS info (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+ENTRY_COLUMNS = ('node', 'name', 'position', 'id', 'version', 'network',
+                 'prefixlen', 'range_first', 'range_last', 'gateway', 'vlan',
+                 'properties', 'metadata')
+
+# the maximum number of parameters of a query (SQLITE_MAX_VARIABLE_NUMBER
+# is 999 in old SQLite versions)
+_CHUNK = 500
+
+
+def _pack_ip(value):
+    return sqlite3.Binary(
+        struct.pack('>QQ', value >> 64, value & 0xffffffffffffffff))
+
+
+def _unpack_ip(data):
+    hi, lo = struct.unpack('>QQ', bytes(data))
+    return hi << 64 | lo
+
+
+def _chunks(items):
+    items = list(items)
+    for i in range(0, len(items), _CHUNK):
+        yield items[i:i + _CHUNK]
+
+
+class Store(object):
+
+    def __init__(self, path, timeout=600.0):
+        """
+        :param path: the database file, created if it does not exist
+        :param timeout: how long to wait (in seconds) for the transaction
+            of another run to finish
+        """
+        # the transactions are started and ended explicitly
+        self._db = sqlite3.connect(path, timeout=timeout,
+                                   isolation_level=None)
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run the block in a transaction, committed at the end of the block
+        or rolled back if it raises an exception
+
+        The database is locked for writing from the start of the
+        transaction, so the data read in the block is not modified by
+        others until the end of the block.
+        """
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield self
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def _query(self, sql, names):
+        """Run a query with an 'IN ({})' condition on the given names"""
+        for chunk in _chunks(names):
+            for row in self._db.execute(
+                    sql.format(', '.join('?' * len(chunk))), chunk):
+                yield row
+
+    def _entries(self, rows):
+        """Convert the entry rows to (node, entry name, Allocation)"""
+        for row in rows:
+            (node, name, _, id_, version, network, prefixlen, range_first,
+             range_last, gateway, vlan, properties, metadata) = row
+            network = _unpack_ip(network)
+            metadata = json.loads(metadata)
+            metadata['id'] = id_
+            yield node, name, Allocation(
+                version, network, prefixlen, _unpack_ip(range_first),
+                _unpack_ip(range_last),
+                _unpack_ip(gateway) - network if gateway is not None
+                else None,
+                vlan, json.loads(properties), metadata)
+
+    def load(self, nodes=None, ip_pools=None, vlan_pools=None):
+        """Load the allocation of the given nodes and pools
+
+        :param nodes: the names of the ipam nodes, or None for all of them
+        :param ip_pools: the names of the IP pools, or None for all of them
+        :param vlan_pools: the names of the VLAN pools, or None for all of
+            them
+        :return: the allocation in the same format as the json output
+            converted by objectify(), except the ip_pool and vlan_pool
+            sections which are left as dicts
+        """
+        def select(table, columns, names, order=''):
+            sql = 'SELECT {} FROM {}'.format(', '.join(columns), table)
+            if names is None:
+                return self._db.execute(sql + order)
+            return self._query(sql + ' WHERE name IN ({})' + order, names)
+
+        ipam = OrderedDict()
+        for name, properties in select('node', ('name', 'properties'), nodes,
+                                       ' ORDER BY position'):
+            ipam[name] = {'properties': json.loads(properties),
+                          'ipa': OrderedDict()}
+
+        sql = 'SELECT {} FROM entry'.format(', '.join(ENTRY_COLUMNS))
+        if nodes is None:
+            rows = self._db.execute(sql + ' ORDER BY position')
+        else:
+            rows = self._query(sql + ' WHERE node IN ({}) ORDER BY position',
+                               ipam)
+        for node, name, v in self._entries(rows):
+            ipam[node]['ipa'][name] = v
+
+        d = {
+            'ipam': ipam,
+            'ip_pool': dict((name, json.loads(data)) for name, data in
+                            select('ip_pool', ('name', 'data'), ip_pools)),
+            'vlan_pool': dict((name, json.loads(data)) for name, data in
+                              select('vlan_pool', ('name', 'data'),
+                                     vlan_pools)),
+        }
+        for (value,) in self._db.execute(
+                "SELECT value FROM info WHERE key = 'properties'"):
+            d['properties'] = json.loads(value)
+        return d
+
+    def save(self, d):
+        """Save the result of an allocation, replacing the entries of its
+        nodes and its pools
+
+        :param d: the result of alloc_ips(), with the ip_pool and vlan_pool
+            sections already converted to dicts
+        """
+        (position,) = self._db.execute(
+            'SELECT COALESCE(MAX(position), -1) FROM node').fetchone()
+        for k, v in d['ipam'].items():
+            properties = json.dumps(v.get('properties', {}))
+            if self._db.execute(
+                    'UPDATE node SET properties = ? WHERE name = ?',
+                    (properties, k)).rowcount == 0:
+                # a new node, added after the existing ones
+                position += 1
+                self._db.execute(
+                    'INSERT INTO node (name, position, properties) '
+                    'VALUES (?, ?, ?)', (k, position, properties))
+
+        self._db.executemany('DELETE FROM entry WHERE node = ?',
+                             ((k,) for k in d['ipam']))
+        self._db.executemany(
+            'INSERT INTO entry ({}) VALUES ({})'.format(
+                ', '.join(ENTRY_COLUMNS), ', '.join('?' * len(ENTRY_COLUMNS))),
+            self._entry_rows(d['ipam']))
+
+        self._db.executemany(
+            'INSERT OR REPLACE INTO ip_pool (name, data) VALUES (?, ?)',
+            ((k, json.dumps(v)) for k, v in d['ip_pool'].items()))
+        self._db.executemany(
+            'INSERT OR REPLACE INTO vlan_pool (name, data) VALUES (?, ?)',
+            ((k, json.dumps(v)) for k, v in d['vlan_pool'].items()))
+        if d.get('properties'):
+            self._db.execute(
+                "INSERT OR REPLACE INTO info (key, value) "
+                "VALUES ('properties', ?)", (json.dumps(d['properties']),))
+
+    @staticmethod
+    def _entry_rows(ipam):
+        for node_k, node in ipam.items():
+            for i, (k, v) in enumerate(node['ipa'].items()):
+                # the id has its own column
+                metadata = dict((k1, v1) for k1, v1 in v.metadata.items()
+                                if k1 != 'id')
+                yield (node_k, k, i, v.metadata['id'], v.version,
+                       _pack_ip(v.network), v.prefixlen,
+                       _pack_ip(v.range_first), _pack_ip(v.range_last),
+                       _pack_ip(v.network + v.gateway_offset)
+                       if v.gateway_offset is not None else None,
+                       v.vlan, json.dumps(v.properties),
+                       json.dumps(metadata))
+
+    def find_subnets(self, version, first, last):
+        """Find the entries with a subnet starting from first to last (as
+        int), e.g. the subnets inside a CIDR
+
+        :return: a list of (node, entry name, Allocation)
+        """
+        return list(self._entries(self._db.execute(
+            'SELECT {} FROM entry WHERE version = ? AND network BETWEEN ? '
+            'AND ? ORDER BY network'.format(', '.join(ENTRY_COLUMNS)),
+            (version, _pack_ip(first), _pack_ip(last)))))
+
+    def find_vlan(self, vlan):
+        """Find the entries with the given VLAN
+
+        :return: a list of (node, entry name, Allocation)
+        """
+        return list(self._entries(self._db.execute(
+            'SELECT {} FROM entry WHERE vlan = ?'.format(
+                ', '.join(ENTRY_COLUMNS)), (vlan,))))
+
+
+def import_file(db, path):
+    """Import the allocation in a json output or snapshot file"""
+    if snapshot.is_snapshot(path):
+        d = snapshot.load(path)
+    else:
+        with open(path) as f:
+            d = json.load(f)
+        for entry in d['ipam'].values():
+            for k, v in entry['ipa'].items():
+                entry['ipa'][k] = Allocation.from_dict(v)
+    with db.transaction():
+        db.save(d)
+
+
+def export_json(db, f):
+    """Write the whole allocation to f in the format of the json output"""
+    d = db.load()
+    for entry in d['ipam'].values():
+        for k, v in entry['ipa'].items():
+            entry['ipa'][k] = v.to_dict()
+    f.write(json.dumps(d, indent=2) + '\n')
+
+
+def main(input_args):
+    parser = argparse.ArgumentParser(
+        description='Import or export an ipa allocation store')
+    parser.add_argument(dest="store",
+                        metavar="FILE.db",
+                        help='the store')
+    subparsers = parser.add_subparsers(dest="command")
+    import_parser = subparsers.add_parser(
+        'import', help='import an allocation in json or snapshot format')
+    import_parser.add_argument(dest="input_file",
+                               help='the result of a previous allocation')
+    export_parser = subparsers.add_parser(
+        'export', help='export the allocation in json format')
+    export_parser.add_argument('--output',
+                               dest="output_file",
+                               metavar="FILE",
+                               help='write the allocation to FILE instead '
+                                    'of stdout')
+    args = parser.parse_args(input_args)
+
+    db = Store(args.store)
+    try:
+        if args.command == 'import':
+            import_file(db, args.input_file)
+        elif args.output_file:
+            with open(args.output_file, 'w') as f:
+                export_json(db, f)
+        else:
+            export_json(db, sys.stdout)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
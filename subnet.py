@@ -1,3 +1,6 @@
+from collections import OrderedDict
+import bisect
+import heapq
 import netaddr
 import logging
 
@@ -8,6 +11,9 @@ class SubnettingError(Exception):
     cannot be created from a parent ip_set
     """
     def __init__(self, value, additional_info=None):
+        # the arguments are kept in args to unpickle the exception
+        # (e.g. when it is raised in a process of ipa -j)
+        super(SubnettingError, self).__init__(value, additional_info)
         self.value = value
         self.additional_info = additional_info
 
@@ -20,6 +26,7 @@ class IpNotInSubnet(Exception):
     To be used when an IP is not part of a subnet
     """
     def __init__(self, ip, subnet, additional_info=None):
+        super(IpNotInSubnet, self).__init__(ip, subnet, additional_info)
         self.ip = ip
         self.subnet = subnet
         self.additional_info = additional_info
@@ -29,6 +36,194 @@ class IpNotInSubnet(Exception):
                .format(self.ip, self.subnet)
 
 
+class IntervalSet(object):
+    """A set of integers (e.g. IP addresses) stored as sorted, disjoint and
+    non adjacent [first, last] intervals
+    """
+
+    def __init__(self, intervals=()):
+        # the first and the last value of each interval, kept in two
+        # parallel sorted lists so they can be searched with bisect
+        self._firsts = []
+        self._lasts = []
+
+        # the number of integers in the set
+        self.size = 0
+
+        for first, last in intervals:
+            self.add(first, last)
+
+    def __repr__(self):
+        return "IntervalSet<{0}>".format(list(self))
+
+    def copy(self):
+        res = IntervalSet()
+        res._firsts = list(self._firsts)
+        res._lasts = list(self._lasts)
+        res.size = self.size
+        return res
+
+    def __len__(self):
+        """The number of intervals in the set"""
+        return len(self._firsts)
+
+    def __iter__(self):
+        return iter(zip(self._firsts, self._lasts))
+
+    def __contains__(self, value):
+        i = bisect.bisect_left(self._lasts, value)
+        return i < len(self._lasts) and self._firsts[i] <= value
+
+    def add(self, first, last):
+        """Add the [first, last] interval to the set"""
+        firsts = self._firsts
+        lasts = self._lasts
+        # the intervals overlapping or adjacent to the new one
+        i = bisect.bisect_left(lasts, first - 1)
+        # fast path for the most common case (e.g. subnets allocated in
+        # order): the interval extends the interval i, and only that one
+        if i < len(firsts) and first >= firsts[i] - 1 and \
+                (i + 1 == len(firsts) or last + 1 < firsts[i + 1]):
+            if first < firsts[i]:
+                self.size += firsts[i] - first
+                firsts[i] = first
+            if last > lasts[i]:
+                self.size += last - lasts[i]
+                lasts[i] = last
+            return
+        j = bisect.bisect_right(firsts, last + 1)
+        if i < j:
+            first = min(first, self._firsts[i])
+            last = max(last, self._lasts[j - 1])
+            for k in range(i, j):
+                self.size -= self._lasts[k] - self._firsts[k] + 1
+        self._firsts[i:j] = [first]
+        self._lasts[i:j] = [last]
+        self.size += last - first + 1
+
+    def remove(self, first, last):
+        """Remove the [first, last] interval from the set"""
+        firsts = self._firsts
+        lasts = self._lasts
+        # the intervals overlapping the removed one
+        i = bisect.bisect_left(lasts, first)
+        # fast path for the most common case (e.g. subnets allocated in
+        # order): the removed interval is inside the interval i
+        if i < len(firsts) and firsts[i] <= first and last <= lasts[i]:
+            self.size -= last - first + 1
+            if firsts[i] == first:
+                if lasts[i] == last:
+                    del firsts[i]
+                    del lasts[i]
+                else:
+                    firsts[i] = last + 1
+            elif lasts[i] == last:
+                lasts[i] = first - 1
+            else:
+                firsts.insert(i + 1, last + 1)
+                lasts.insert(i + 1, lasts[i])
+                lasts[i] = first - 1
+            return
+        j = bisect.bisect_right(self._firsts, last)
+        if i >= j:
+            return
+        firsts, lasts = [], []
+        # keep what is left of the first and the last overlapping interval
+        if self._firsts[i] < first:
+            firsts.append(self._firsts[i])
+            lasts.append(first - 1)
+        if self._lasts[j - 1] > last:
+            firsts.append(last + 1)
+            lasts.append(self._lasts[j - 1])
+        for k in range(i, j):
+            self.size -= self._lasts[k] - self._firsts[k] + 1
+        for f, l in zip(firsts, lasts):
+            self.size += l - f + 1
+        self._firsts[i:j] = firsts
+        self._lasts[i:j] = lasts
+
+    def overlapping(self, first, last):
+        """Return the first interval in the set that overlaps [first, last]
+        or None if there is no such interval"""
+        i = bisect.bisect_left(self._lasts, first)
+        if i < len(self._firsts) and self._firsts[i] <= last:
+            return self._firsts[i], self._lasts[i]
+        return None
+
+    def iter_cidrs(self, width):
+        """Split the intervals into the largest possible aligned blocks
+
+        :param width: the number of bits of the values (32 or 128 for IPs)
+        :return: a generator of (first, prefixlen) tuples, sorted by first
+        """
+        for first, last in self:
+            while first <= last:
+                # the biggest block that starts at 'first'
+                # and does not go past 'last'
+                size = first & -first or 1 << width
+                while size > last - first + 1:
+                    size >>= 1
+                yield first, width - size.bit_length() + 1
+                first += size
+
+
+class MaxSizeTree(object):
+    """The size of the intervals of a set, by the first value of each
+    interval, kept in a sparse segment tree over the range of values so the
+    first (or the last) interval of a given size is found in O(log n)
+
+    Each node of the tree covers an aligned block of values and holds the
+    size of the biggest interval starting in that block.
+    """
+
+    def __init__(self, first, last):
+        """
+        :param first: the first value of the range the intervals are in
+        :param last: the last value of the range the intervals are in
+        """
+        self._base = first
+        # the number of levels below the root
+        self._depth = (last - first).bit_length()
+        # (level, block index) -> the size of the biggest interval,
+        # for the blocks with intervals only; the root is (0, 0)
+        self._max = {}
+
+    def set(self, first, size):
+        """Set the size of the interval starting at first (0 to remove it)"""
+        m = self._max
+        level, i = self._depth, first - self._base
+        if size:
+            m[(level, i)] = size
+        else:
+            m.pop((level, i), None)
+        while level > 0:
+            size = max(m.get((level, i), 0), m.get((level, i ^ 1), 0))
+            level, i = level - 1, i >> 1
+            if m.get((level, i), 0) == size:
+                # the blocks above are not changed either
+                break
+            if size:
+                m[(level, i)] = size
+            else:
+                del m[(level, i)]
+
+    def find(self, size, reverse=False):
+        """Return the first value of the first interval (by value) with at
+        least size values, or None if there is no such interval
+
+        :param reverse: return the last such interval instead
+        """
+        m = self._max
+        if m.get((0, 0), 0) < size:
+            return None
+        i = 0
+        for level in range(1, self._depth + 1):
+            i <<= 1
+            first, second = (i + 1, i) if reverse else (i, i + 1)
+            i = first if m.get((level, first), 0) >= size else second
+        return self._base + i
+
+
 class IPPool(object):
     """A IPv4 or IPv6 subnet or a slice of a subnet
     """
@@ -45,7 +240,9 @@ class IPPool(object):
         If only 'end_ip' is specified, include all IP address starting from
         first usable IP until end_ip (inclusive).
 
-        Note: The result is stored in self.pool which has type netaddr.IPSet
+        Note: The free space is kept as integer intervals (self._free),
+        indexed by per-prefixlen free lists (self._bins), and exposed as a
+        netaddr.IPSet through self.pool
 
         :param cidr: an IP network
         :type cidr: str
@@ -60,10 +257,17 @@ class IPPool(object):
         self.log = logging.getLogger(self.__class__.__name__)
 
         # keep track of the subnets and IP addresses assigned to other subnets
-        self.reserved = netaddr.IPSet()
+        self._reserved = IntervalSet()
+
+        # the free IP addresses of the pool
+        self._free = IntervalSet()
 
-        # the main pool
-        self.pool = None
+        # the free blocks of the pool, buddy allocator style:
+        # prefixlen -> heap with the first IP (as int) of each free block
+        self._bins = {}
+
+        # the number of subnets allocated from the pool
+        self.allocations = 0
 
         # a copy of the original input
         self.input = (cidr, start_ip, end_ip)
@@ -77,6 +281,9 @@ class IPPool(object):
         # the IP version
         self.version = net.version
 
+        # the number of bits in an IP address of this version
+        self.width = net._module.width
+
         # check if an IP range (a part of a subnet) was requested
         if start_ip is not None or end_ip is not None:
             # if start_ip is missing, use the first IP in the subnet
@@ -95,18 +302,41 @@ class IPPool(object):
                 if end_ip not in net:
                     raise IpNotInSubnet(end_ip, str(net))
 
-            # generate the IP range and store it in self.ip_range
+            # generate the IP range and use it as free space
             ip_range = netaddr.IPRange(start_ip, end_ip)
-
-            # translate the range into an IPSet and store it in self.pool
-            self.pool = netaddr.IPSet(ip_range)
+            self._space = (ip_range.first, ip_range.last)
 
         else:
-            # translate the net to IPSet and store it in self.pool
-            self.pool = netaddr.IPSet(net)
+            # use the entire net as free space
+            self._space = (net.first, net.last)
+
+        # the number of IP addresses in the pool
+        self.size = self._space[1] - self._space[0] + 1
+
+        self._set_free([self._space])
 
         self.log.debug("New IPPool created: {0}".format(self.__repr__()))
 
+    def __getstate__(self):
+        # the logger is not pickled (e.g. when sent to another process)
+        state = self.__dict__.copy()
+        del state['log']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def copy(self):
+        """Return a copy of the pool, which can be allocated from without
+        changing this one"""
+        res = IPPool.__new__(IPPool)
+        res.__dict__.update(self.__dict__)
+        res._reserved = self._reserved.copy()
+        res._free = self._free.copy()
+        res._bins = dict((k, list(v)) for k, v in self._bins.items())
+        return res
+
     def __repr__(self):
 
         if self.input[1] is not None or self.input[2] is not None:
@@ -116,125 +346,392 @@ class IPPool(object):
         else:
             return "IPPool<'{0}'>".format(self.input[0])
 
+    @property
+    def pool(self):
+        """The free space of the pool, as a netaddr.IPSet
+
+        Note: the set is built on every access so it should only be used
+        when the pool is exported or inspected
+        """
+        return netaddr.IPSet(self.iter_cidrs())
+
+    @pool.setter
+    def pool(self, ip_set):
+        """Replace the free space of the pool with the given netaddr.IPSet"""
+        self.set_unused(ip_set.iter_cidrs())
+
+    @property
+    def reserved(self):
+        """The allocated space of the pool, as a netaddr.IPSet"""
+        return netaddr.IPSet(
+            netaddr.IPNetwork((first, prefixlen), version=self.version)
+            for first, prefixlen in self._reserved.iter_cidrs(self.width))
+
+    def iter_cidrs(self):
+        """The free space of the pool, split in the largest possible subnets
+
+        :return: a generator of netaddr.IPNetwork, sorted by address
+        """
+        for first, prefixlen in self._free.iter_cidrs(self.width):
+            yield netaddr.IPNetwork((first, prefixlen), version=self.version)
+
+    def set_unused(self, cidrs):
+        """Replace the free space of the pool with the given subnets
+
+        The rest of the pool is considered reserved, e.g. when a pool
+        is restored from a previous allocation.
+
+        :param cidrs: the free subnets
+        :type cidrs: an iterable of str or netaddr.IPNetwork
+        """
+        intervals = []
+        for cidr in cidrs:
+            net = netaddr.IPNetwork(cidr)
+            intervals.append((net.first, net.last))
+        self._set_free(intervals)
+
+        self._reserved = IntervalSet([self._space])
+        for first, last in self._free:
+            self._reserved.remove(first, last)
+
+    def is_allocated(self, net):
+        """Check if a subnet was allocated from the pool
+
+        :param net: the subnet
+        :type net: netaddr.IPNetwork or netaddr.IPRange
+        :rtype: bool
+        """
+        return self.is_reserved(net.version, net.first, net.last)
+
+    def is_reserved(self, version, first, last):
+        """Same as is_allocated() for the IPs from first to last (as int)"""
+        if version != self.version:
+            return False
+        # the reserved intervals are merged so the IPs have to be
+        # entirely inside one of them
+        interval = self._reserved.overlapping(first, last)
+        return interval is not None and \
+            interval[0] <= first and last <= interval[1]
+
+    @property
+    def free_fragments(self):
+        """The number of contiguous free IP ranges in the pool"""
+        return len(self._free)
+
+    @property
+    def free_size(self):
+        """The number of free IP addresses in the pool"""
+        return self._free.size
+
+    @property
+    def used_size(self):
+        """The number of allocated IP addresses in the pool"""
+        return self.size - self._free.size
+
+    @property
+    def largest_free_prefixlen(self):
+        """The prefixlen of the biggest subnet that can still be allocated
+        from the pool, or None if the pool is full"""
+        plens = [plen for plen, bin_ in self._bins.items() if bin_]
+        return min(plens) if plens else None
+
+    def fit_counts(self, prefixlens=None):
+        """The number of subnets of each prefixlen that can still be
+        allocated from the pool
+
+        The counts come from the sizes of the free lists, which are kept
+        up to date by the allocations, so the free space is not scanned.
+
+        :param prefixlens: the prefixlens to count. Default: all the
+            prefixlens from the biggest free subnet to the host prefixlen
+        :return: OrderedDict of prefixlen -> count, by prefixlen
+        """
+        largest = self.largest_free_prefixlen
+        if prefixlens is None:
+            prefixlens = range(largest, self.width + 1) \
+                if largest is not None else []
+        prefixlens = sorted(set(prefixlens))
+        res = OrderedDict()
+        count = 0
+        plen = 0
+        for prefixlen in prefixlens:
+            # each free /plen block holds two /(plen + 1) subnets
+            while plen <= prefixlen:
+                count = count * 2 + len(self._bins.get(plen, ()))
+                plen += 1
+            res[prefixlen] = count
+        return res
+
+    def _set_free(self, intervals):
+        """Rebuild the free space and the free lists from int intervals"""
+        self._free = IntervalSet(intervals)
+        self._bins = {}
+        # the blocks are sorted by address so each free list is a valid heap
+        for first, prefixlen in self._free.iter_cidrs(self.width):
+            self._bins.setdefault(prefixlen, []).append(first)
+
     def allocate_subnet(self, prefixlen):
         """Generate a subnet of the specified prefixlen from a set of parent
          nets (self.pool) in the most optimal way (will try to always
         allocate the subnet from the best matching existing net in the set)
 
-        The allocated subnet is removed from the set and saved in
-        self.allocations
+        The free blocks are kept in per-prefixlen free lists, so the best
+        match is the lowest free block in the bin with the longest prefixlen
+        that is not longer than the requested one. When the best match is
+        bigger than requested, it is split buddy style: the first subnet is
+        allocated and the remaining halves are put back in the free lists.
+
+        The allocated subnet is removed from the pool and saved in
+        self.reserved
 
         :param prefixlen: the mask of the subnets to be generated
         :type prefixlen: int
         :return: the subnet allocated
         :rtype: netaddr.IPNetwork
         """
-        # make the self.pool as compact as possible
-        self.pool.compact()
-
-        # find the best matching net inside the set to be used for allocation
-        self.log.debug("Finding the best net in {0} to create a /{1} subnet"
-                       .format(self.pool, prefixlen))
-
-        # variable used to store the best match
-        # the format is: (netaddr.IPNetwork, cost)
-        # where the cost is the difference between the requested prefixlen
-        # and the best_match prefixlen; ideally the cost is 0, i.e,
-        # the best match subnet has the same prefixlen as the requested one
-        best_match = (None, 999)
-
-        for net in self.pool.iter_cidrs():
-            # best case scenario: there is a net in the IPSet with the
-            # same prefixlen as the requested one
-            if net.prefixlen == prefixlen:
-                best_match = (net, 0)
-                # we already found the best match possible so stop searching
-                break
-
-            # if the prefixlen of the current net is lower than the requested,
-            # one, this net can be used for subnetting if it's a better match
-            # than the current best_match
-            elif net.prefixlen < prefixlen:
-                cost = prefixlen - net.prefixlen
-                if cost < best_match[1]:
-                    # the current net is a better match than
-                    # the existing best_match
-                    best_match = (net, cost)
-
-        self.log.debug("Best match found: {0}".format(best_match))
-        # error if there is no suitable subnet
-        if best_match[0] is None:
-            raise SubnettingError(
-                "Could not allocate a /{0} subnet from {1}"
-                .format(prefixlen, self.pool))
+        return self.allocate_subnets([prefixlen])[0]
 
-        # create and validate the subnet
-        # the IPNetwork.subnet() splits the entire net into a generator of
-        # subnets of the specified prefixlen
-        # take the first subnet from the generator
-        try:
-            subnet = next(best_match[0].subnet(prefixlen))
-            self.log.debug("Allocated subnet: {0}".format(subnet))
-
-        except netaddr.AddrFormatError:
-            raise SubnettingError("Invalid prefixlen: {0}".format(prefixlen))
+    def allocate_subnets(self, prefixlens):
+        """Allocate a subnet for each of the given prefixlens, in order
 
-        # save the subnet into self.reserved and remove it from self.pool
-        self.reserved.add(subnet)
-        self.pool.remove(subnet)
-        self.log.debug("Status after allocation: pool={0}, reserved={1}"
-                       .format(self.pool, self.reserved))
+        The result is the same as calling allocate_subnet() for each
+        prefixlen but the free lists are only looked up once for the batch.
+        If a subnet cannot be allocated, the subnets allocated before it
+        stay allocated.
 
-        return subnet
+        :param prefixlens: the masks of the subnets to be generated
+        :type prefixlens: list of int
+        :return: the subnets allocated
+        :rtype: list of netaddr.IPNetwork
+        """
+        return [netaddr.IPNetwork((first, prefixlen), version=self.version)
+                for first, prefixlen in
+                zip(self.allocate_blocks(prefixlens), prefixlens)]
+
+    def allocate_blocks(self, prefixlens):
+        """Same as allocate_subnets() but return the first IP of each
+        subnet, as int, instead of netaddr.IPNetwork objects"""
+        width = self.width
+        bins = self._bins
+        free = self._free
+        reserved = self._reserved
+        res = []
+
+        for prefixlen in prefixlens:
+            if not 0 <= prefixlen <= width:
+                raise SubnettingError(
+                    "Invalid prefixlen: {0}".format(prefixlen))
+
+            # find the best matching free block, i.e. the one with the
+            # smallest difference between its prefixlen and the requested one
+            plen = prefixlen
+            bin_ = bins.get(plen)
+            while not bin_:
+                plen -= 1
+                if plen < 0:
+                    raise SubnettingError(
+                        "Could not allocate a /{0} subnet from {1}"
+                        .format(prefixlen, self.pool))
+                bin_ = bins.get(plen)
+
+            first = heapq.heappop(bin_)
+
+            # split the block: keep the first half and return the upper half
+            # (the buddy) to the free lists until the requested size is
+            # reached
+            while plen < prefixlen:
+                plen += 1
+                heapq.heappush(bins.setdefault(plen, []),
+                               first + (1 << (width - plen)))
+
+            # move the subnet from the free space to the reserved space
+            last = first + (1 << (width - prefixlen)) - 1
+            free.remove(first, last)
+            reserved.add(first, last)
+
+            res.append(first)
+            self.allocations += 1
+
+        # only build the (possibly long) list of subnets when needed
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Allocated subnets: %s", [
+                netaddr.IPNetwork((x, y), version=self.version)
+                for x, y in zip(res, prefixlens)])
+        return res
 
     def allocate_biggest_subnet(self):
         """Allocate the biggest available subnet in the IP pool
         :return: the biggest available subnet in the IP pool
         :rtype: netaddr.IPNetwork
         """
-        # make the self.pool as compact as possible
-        self.pool.compact()
-
-        # the firs cidr returned by iter_cidrs() is the largest one
+        # use the first free block (by address)
         try:
-            subnet = self.pool.iter_cidrs()[0]
-        except IndexError:
+            first, prefixlen = min(
+                (bin_[0], plen) for plen, bin_ in self._bins.items() if bin_)
+        except ValueError:
             raise SubnettingError(
                 "Could not allocate the biggest available subnet "
                 "as the IP pool is empty")
         else:
-            self.reserved.add(subnet)
+            # the block is the smallest one of its free list
+            heapq.heappop(self._bins[prefixlen])
+            subnet = netaddr.IPNetwork((first, prefixlen),
+                                       version=self.version)
+            self._free.remove(subnet.first, subnet.last)
+            self._reserved.add(subnet.first, subnet.last)
+            self.allocations += 1
             return subnet
 
 
 class IpRangeAllocator(object):
+    """Allocate IP ranges from the usable IP addresses of a subnet
 
-    def __init__(self, net, start_index=None, end_index=None):
+    The free addresses are kept as int intervals (self._free) and, to find
+    the best fit with a binary search, as a sorted list of (size, first IP)
+    of the free intervals (self._by_size). The size of the free intervals
+    is also indexed by address (self._fit) to find the first and the last
+    interval that is big enough in O(log n).
+    """
+
+    def __init__(self, net, start_index=None, end_index=None, best_fit=False):
+        """
+        :param net: the subnet to allocate the ranges from
+        :param start_index: the index of the first usable IP in the subnet.
+            Default: 1 (skip the network IP)
+        :param end_index: the index of the last usable IP in the subnet.
+            Default: -2 (skip the broadcast IP)
+        :param best_fit: allocate the ranges from the smallest free interval
+            that is big enough, instead of the first one
+        """
         if not isinstance(net, netaddr.IPNetwork):
             self._net = netaddr.IPNetwork(net)
         else:
             self._net = net
 
+        self.version = self._net.version
+        self.best_fit = best_fit
+
         # convert the subnet into a range of usable IP addresses
-        # (skip the network and broadcast IPs)
+        # (skip the network and broadcast IPs); the indexes are converted
+        # with ints as a big IPv6 subnet does not fit in len()
         start_idx = int(start_index) if start_index else 1
         end_idx = int(end_index) if end_index else -2
-        self._range = netaddr.IPRange(self._net[start_idx], self._net[end_idx])
+        size = self._net.size
+        first = self._net.first + (start_idx if start_idx >= 0
+                                   else size + start_idx)
+        last = self._net.first + (end_idx if end_idx >= 0
+                                  else size + end_idx)
+        if not self._net.first <= first <= last <= self._net.last:
+            raise SubnettingError(
+                "Invalid IP range indexes for {0}: {1}, {2}"
+                .format(self._net, start_idx, end_idx))
+        self._free = IntervalSet([(first, last)])
+        self._by_size = [(last - first + 1, first)]
+        self._fit = MaxSizeTree(first, last)
+        self._fit.set(first, last - first + 1)
+
+        # the number of usable IP addresses
+        self.size = last - first + 1
+
+        # the number of IP ranges allocated
+        self.allocations = 0
+
+    @property
+    def free_fragments(self):
+        """The number of contiguous free IP ranges"""
+        return len(self._free)
+
+    @property
+    def free_size(self):
+        """The number of free IP addresses"""
+        return self._free.size
+
+    @property
+    def used_size(self):
+        """The number of allocated IP addresses"""
+        return self.size - self._free.size
+
+    @property
+    def largest_free_size(self):
+        """The size of the biggest IP range that can still be allocated"""
+        return self._by_size[-1][0] if self._by_size else 0
+
+    def _take(self, first, last):
+        """Remove [first, last], which is inside a free interval, from the
+        free addresses"""
+        start, end = self._free.overlapping(first, last)
+        del self._by_size[bisect.bisect_left(self._by_size,
+                                             (end - start + 1, start))]
+        self._fit.set(start, 0)
+        self._free.remove(first, last)
+        # put back what is left of the free interval
+        for start1, end1 in ((start, first - 1), (last + 1, end)):
+            if start1 <= end1:
+                bisect.insort(self._by_size, (end1 - start1 + 1, start1))
+                self._fit.set(start1, end1 - start1 + 1)
+
+    def _to_range(self, first, last):
+        return netaddr.IPRange(netaddr.IPAddress(first, self.version),
+                               netaddr.IPAddress(last, self.version))
+
+    def reserve(self, ip_range):
+        """Mark an IPRange allocated before (e.g. in a previous run) as used
+
+        :raises: SubnettingError if the range is not free
+        """
+        self.reserve_interval(ip_range.first, ip_range.last)
+
+    def reserve_interval(self, first, last):
+        """Same as reserve() for the IPs from first to last (as int)"""
+        interval = self._free.overlapping(first, last)
+        if interval is None or interval[0] > first or interval[1] < last:
+            raise SubnettingError(
+                "IP range {0} is not free in {1}".format(
+                    self._to_range(first, last), self._net))
+        self._take(first, last)
 
     def alloc(self, size, from_the_back=False):
-        """Allocate an IPRange of the given size from the subnet"""
-        assert size < self._range.size, \
-            "Not enough addresses left to allocate the requested IP range. " \
-            "Requested {}, available {}".format(size, self._range.size - 1)
-        # allocate the requested range then remove those IP from the pool
-        # allocate from the back of the range if that option is specified
+        """Allocate an IPRange of the given size from the subnet (see
+        alloc_interval())"""
+        return self._to_range(*self.alloc_interval(size, from_the_back))
+
+    def alloc_interval(self, size, from_the_back=False):
+        """Allocate a range of IPs of the given size from the subnet and
+        return its first and its last IP (as int)
+
+        The range is allocated from the first free interval that is big
+        enough (or from the last one if from_the_back is set), or from the
+        smallest one if best_fit is set. The addresses are taken from the
+        front of the interval, or from the back if from_the_back is set.
+
+        :raises: SubnettingError if there is no free interval big enough
+        """
+        if size < 1:
+            raise SubnettingError("Invalid IP range size: {0}".format(size))
+
+        if self.best_fit:
+            i = bisect.bisect_left(self._by_size, (size, -1))
+            interval = None
+            if i < len(self._by_size):
+                first = self._by_size[i][1]
+                interval = (first, first + self._by_size[i][0] - 1)
+        else:
+            first = self._fit.find(size, reverse=from_the_back)
+            interval = None
+            if first is not None:
+                interval = self._free.overlapping(first, first)
+
+        if interval is None:
+            raise SubnettingError(
+                "Not enough addresses left in {0} to allocate the requested "
+                "IP range. Requested {1}, largest free range {2}".format(
+                    self._net, size,
+                    self._by_size[-1][0] if self._by_size else 0))
+
         if from_the_back:
-            sip = self._range[len(self._range) - size]
-            r = netaddr.IPRange(
-                self._range[len(self._range) - size], self._range.last)
-            self._range = netaddr.IPRange(
-                self._range.first, self._range[len(self._range) - size - 1])
+            first, last = interval[1] - size + 1, interval[1]
         else:
-            r = netaddr.IPRange(self._range.first, self._range[size - 1])
-            self._range = netaddr.IPRange(self._range[size], self._range.last)
-        return r
+            first, last = interval[0], interval[0] + size - 1
+        self._take(first, last)
+        self.allocations += 1
+        return first, last